@@ -0,0 +1,91 @@
+"""pdf_updown の負荷試験
+
+N人の読者が同時に同じPDFをページ順に読み進めたときの、エンドポイントごとのレイテンシ(p50/p99)を表示する。
+
+$ uvicorn pdf_updown:app --port 8000
+$ python -m benchmarks.pdf_updown_load_test --url "https://arxiv.org/pdf/xxxx.yyyyy" --readers 8 --pages 5
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from collections import defaultdict
+
+import httpx
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base_url", type=str, default="http://localhost:8000")
+    parser.add_argument("--url", type=str, required=True)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--pages", type=int, default=5)
+    parser.add_argument("--with_audio", action="store_true")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    return parser.parse_args()
+
+
+class Recorder:
+    def __init__(self):
+        self.__latencies: dict[str, list[float]] = defaultdict(list)
+        self.__errors: dict[str, int] = defaultdict(int)
+
+    async def request(self, name: str, client: httpx.AsyncClient, method: str, path: str, **kwargs) -> httpx.Response:
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, path, **kwargs)
+            response.raise_for_status()
+        except httpx.HTTPError:
+            self.__errors[name] += 1
+            raise
+        finally:
+            self.__latencies[name].append(time.perf_counter() - start)
+        return response
+
+    def show(self):
+        print(f"{'endpoint':<14}{'n':>6}{'err':>6}{'p50[ms]':>12}{'p99[ms]':>12}{'max[ms]':>12}")
+        for name, latencies in self.__latencies.items():
+            latencies = sorted(latencies)
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            print(
+                f"{name:<14}{len(latencies):>6}{self.__errors[name]:>6}"
+                f"{statistics.median(latencies) * 1000:>12.1f}{p99 * 1000:>12.1f}{latencies[-1] * 1000:>12.1f}"
+            )
+
+
+async def read_document(recorder: Recorder, client: httpx.AsyncClient, url: str, pages: int, with_audio: bool):
+    response = await recorder.request("init", client, "POST", "/init/", json={"url": url})
+    request_id = response.json()["request_id"]
+    page_num = response.json()["page_num"]
+    for page in range(1, min(pages, page_num) + 1):
+        body = {"request_id": request_id, "page": page}
+        await asyncio.gather(
+            recorder.request("image", client, "POST", "/image/", json=body),
+            recorder.request("explain", client, "POST", "/explain/", json=body),
+        )
+        if with_audio:
+            await recorder.request("audio_stream", client, "GET", "/audio_stream/", params=body)
+
+
+async def run(args):
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.readers * 3)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *[read_document(recorder, client, args.url, args.pages, args.with_audio) for _ in range(args.readers)],
+            return_exceptions=True,
+        )
+        elapsed = time.perf_counter() - start
+    failed = sum(isinstance(result, Exception) for result in results)
+    print(f"readers: {args.readers} (failed: {failed}), elapsed: {elapsed:.1f} s")
+    recorder.show()
+
+
+def main():
+    asyncio.run(run(parse_args()))
+
+
+if __name__ == "__main__":
+    main()
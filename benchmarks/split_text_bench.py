@@ -0,0 +1,76 @@
+"""split_text のベンチマーク
+
+$ python -m benchmarks.split_text_bench --size 1000000
+"""
+
+import argparse
+import random
+import sys
+import time
+
+from utils.voice_utils import iter_split_text
+
+SEPARATORS = ["。", "、", ". "]
+
+
+def split_text_recursive(text: str, max_length: int, separators: list[str]) -> list[str]:
+    """比較用の、以前の再帰で分割するsplit_text"""
+    if len(text) < max_length:
+        return [text]
+
+    sub = text[:max_length]
+    candidates = [sub.rsplit(separator, 1)[0] + separator for separator in separators if separator in sub]
+    if candidates:
+        pos = max([len(x) for x in candidates])
+    else:
+        pos = max_length
+
+    return [text[:pos]] + split_text_recursive(text[pos:], max_length, separators)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=1_000_000)
+    parser.add_argument("--max_length", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip_recursive", action="store_true")
+    return parser.parse_args()
+
+
+def make_text(size: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    words = ["これは", "論文の", "要約", "です", "提案手法は", "従来手法より", "高速", "model", "data"]
+    separators = ["。", "、", ". ", ""]
+    parts: list[str] = []
+    length = 0
+    while length < size:
+        part = rng.choice(words) + rng.choice(separators)
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)[:size]
+
+
+def measure(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    args = parse_args()
+    text = make_text(args.size)
+
+    elapsed = measure(lambda: sum(1 for _ in iter_split_text(text, args.max_length, SEPARATORS)), args.repeat)
+    print(f"iter_split_text: {elapsed * 1000:.1f} ms ({args.size} chars)")
+
+    if not args.skip_recursive:
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), args.size // args.max_length * 4 + 1000))
+        elapsed = measure(lambda: split_text_recursive(text, args.max_length, SEPARATORS), args.repeat)
+        print(f"recursive split_text: {elapsed * 1000:.1f} ms ({args.size} chars)")
+
+
+if __name__ == "__main__":
+    main()
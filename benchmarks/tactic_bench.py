@@ -0,0 +1,108 @@
+"""Tacticの段ごとのオーバーヘッド(LLMの呼び出し以外)のベンチマーク
+
+大きなArxivSummaryを入力に、LLMを呼ばない段をsteps個つないだTacticを組み立てて実行する。
+文脈の組み立ては、検証しながらコピーする方法(model_validate)と比較する。
+
+$ python -m benchmarks.tactic_bench --steps 20 --authors 500
+"""
+
+import argparse
+import time
+from datetime import datetime, timezone
+from typing import Any, Type
+
+from jinja2 import Template
+from pydantic import BaseModel
+
+from utils.arxiv_utils import ArxivAuthor, ArxivLink, ArxivSummary
+from utils.prompt_utils import Adapter, Executor, TacticBuilder, TypedPrompt, context_type_after, extend_context
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--authors", type=int, default=500)
+    parser.add_argument("--summary_size", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    return parser.parse_args()
+
+
+def make_summary(authors: int, summary_size: int) -> ArxivSummary:
+    now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return ArxivSummary(
+        authors=[ArxivAuthor(name=f"author {i}") for i in range(authors)],
+        categories=["cs.CV"],
+        comment=None,
+        doi=None,
+        entry_id="http://arxiv.org/abs/2401.00001v1",
+        journal_ref=None,
+        links=[ArxivLink(href="http://arxiv.org/pdf/2401.00001v1", title="pdf", rel="related", content_type=None)],
+        primary_category="cs.CV",
+        published=now,
+        summary="a" * summary_size,
+        title="title",
+        updated=now,
+    )
+
+
+def measure(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+class Title(BaseModel):
+    title: str
+
+
+TEMPLATE = Template("{{ title }}")
+
+
+def build(steps: int):
+    builder = TacticBuilder("bench", input_type=ArxivSummary)
+    for i in range(steps):
+        builder.add_typed_prompt(
+            f"step_{i}",
+            adapter=Adapter.project(Title),
+            typed_prompt=TypedPrompt(TEMPLATE, input_type=Title, output_type=str),
+            executor=Executor(lambda text: text, 1),
+            depends_on=[] if i == 0 else [f"step_{i - 1}"],
+        )
+    return builder.build()
+
+
+def accumulate(summary: ArxivSummary, steps: int, extend) -> BaseModel:
+    # 段の出力を1つずつ文脈に足していく部分だけを取り出したもの
+    context: BaseModel = summary
+    context_type: Type[BaseModel] = ArxivSummary
+    for i in range(steps):
+        context_type = context_type_after(context_type, f"step_{i}", str)
+        context = extend(context_type, context, f"step_{i}", "title")
+    return context
+
+
+def validate_copy(next_type: Type[BaseModel], context: BaseModel, name: str, value: Any) -> BaseModel:
+    return next_type(**{name: value}, **context.model_dump(exclude_unset=True))
+
+
+def main():
+    args = parse_args()
+    summary = make_summary(args.authors, args.summary_size)
+
+    elapsed = measure(lambda: build(args.steps), args.repeat)
+    print(f"build: {elapsed * 1000:.2f} ms ({args.steps} steps, {elapsed / args.steps * 1e6:.1f} us/step)")
+
+    tactic = build(args.steps)
+    elapsed = measure(lambda: tactic(summary), args.repeat)
+    print(f"run: {elapsed * 1000:.2f} ms ({elapsed / args.steps * 1e6:.1f} us/step)")
+
+    for name, extend in [("model_construct", extend_context), ("model_validate", validate_copy)]:
+        elapsed = measure(lambda extend=extend: accumulate(summary, args.steps, extend), args.repeat)
+        print(f"accumulate ({name}): {elapsed * 1000:.2f} ms ({elapsed / args.steps * 1e6:.1f} us/step)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
+import asyncio
+import functools
 import os
 import sys
+import time
 from pathlib import Path
-from typing import Optional
+from typing import Any, Awaitable, Callable, Literal, Optional
 
 import click
 import openai
@@ -10,16 +13,25 @@ from pydantic import BaseModel
 
 from llm_tools.utils.click_utils import set_completions_command
 from utils.arxiv_utils import ArxivSummary
-from utils.cache_utils import cache_output_text
-from utils.voice_utils import text_to_wav, VoiceVoxSpeaker
+from utils.cache_utils import cache_output_text, write_text_atomic
+from utils.voice_utils import text_to_wav, VoiceVoxSpeaker, create_voice_cache, DEFAULT_VOICE_CACHE_DIR
 from utils.prompt_utils import (
     load_template,
     TacticBuilder,
     Adapter,
     TypedPrompt,
     Executor,
+    Tactic,
     call_gpt,
+    call_gpt_async,
+    CALL_GPT_MODEL,
+    DEFAULT_TEMPLATE_BYTECODE_CACHE_DIR,
+    TemplateRegistry,
 )
+from utils.llm_cache import LLMCache, create_llm_cache, DEFAULT_LLM_CACHE_PATH
+from utils.rate_limit import RateLimiter
+from utils.task_utils import Pipeline, Stage, StageMetrics, run_batch
+from utils.time_utils import jst_now, time_json_representation
 
 APP_NAME = "text-to-voice"
 
@@ -33,22 +45,66 @@ class SummaryText(BaseModel):
     summary: str
 
 
-def build_tactic(
+# call_gpt_asyncと同じく、キーワード引数(response_format)を受け取れること
+AsyncCall = Optional[Callable[..., Awaitable[str]]]
+
+
+def _build_tactic(
     tactic_name: str,
     prompt_path: Path,
     prompt_root: Optional[Path],
     max_retry: int,
     verbose: bool,
-):
+    async_call: AsyncCall,
+    cache: Optional[LLMCache],
+) -> tuple[Tactic, Callable[[str], BaseModel]]:
     if tactic_name == "single":
-        return _build_single_tactic(prompt_path, prompt_root, max_retry, verbose)
+        return _build_single_tactic(prompt_path, prompt_root, max_retry, verbose, async_call, cache)
     elif tactic_name == "sequence":
-        return _build_sequence_tactic(prompt_path, prompt_root, max_retry, verbose)
+        return _build_sequence_tactic(prompt_path, prompt_root, max_retry, verbose, async_call, cache)
     else:
         raise ValueError(f"Unknown tactic: {tactic_name}")
 
 
-def _build_single_tactic(prompt_path: Path, prompt_root: Path | None, max_retry: int, verbose: bool):
+def build_tactic(
+    tactic_name: str,
+    prompt_path: Path,
+    prompt_root: Optional[Path],
+    max_retry: int,
+    verbose: bool,
+    cache: Optional[LLMCache] = None,
+):
+    fn, parse_input = _build_tactic(tactic_name, prompt_path, prompt_root, max_retry, verbose, None, cache)
+    return lambda text: fn(parse_input(text))[0]
+
+
+def build_async_tactic(
+    tactic_name: str,
+    prompt_path: Path,
+    prompt_root: Optional[Path],
+    max_retry: int,
+    verbose: bool,
+    async_call: Callable[..., Awaitable[str]],
+    cache: Optional[LLMCache] = None,
+):
+    """build_tacticのasyncio版。LLMの呼び出しにはasync_callを使う"""
+    fn, parse_input = _build_tactic(tactic_name, prompt_path, prompt_root, max_retry, verbose, async_call, cache)
+
+    async def run(text: str):
+        result, _ = await fn.run_async(parse_input(text))
+        return result
+
+    return run
+
+
+def _build_single_tactic(
+    prompt_path: Path,
+    prompt_root: Path | None,
+    max_retry: int,
+    verbose: bool,
+    async_call: AsyncCall,
+    cache: Optional[LLMCache],
+):
     builder = TacticBuilder("create_description", input_type=SummaryText)
 
     builder.add_typed_prompt(
@@ -59,12 +115,11 @@ def _build_single_tactic(prompt_path: Path, prompt_root: Path | None, max_retry:
             input_type=SummaryText,
             output_type=str,
         ),
-        executor=Executor(call_gpt, max_retry),
+        executor=Executor(call_gpt, max_retry, async_call, cache=cache, model=CALL_GPT_MODEL, structured_output=True),
     )
     if verbose:
         builder.show_typed_prompts()
-    fn = builder.build()
-    return lambda text: fn(SummaryText(summary=text))[0]
+    return builder.build(), lambda text: SummaryText(summary=text)
 
 
 class SummaryJP(BaseModel):
@@ -79,7 +134,14 @@ class KeyWords(BaseModel):
     necessary_knowledge: list[str]
 
 
-def _build_sequence_tactic(prompt_path: Path, prompt_root: Path | None, max_retry: int, verbose: bool):
+def _build_sequence_tactic(
+    prompt_path: Path,
+    prompt_root: Path | None,
+    max_retry: int,
+    verbose: bool,
+    async_call: AsyncCall,
+    cache: Optional[LLMCache],
+):
     builder = TacticBuilder("create_description", input_type=ArxivSummary)
     builder.add_typed_prompt(
         "summary_to_description",
@@ -89,7 +151,7 @@ def _build_sequence_tactic(prompt_path: Path, prompt_root: Path | None, max_retr
             input_type=ArxivSummary,
             output_type=SummaryJP,
         ),
-        executor=Executor(call_gpt, max_retry),
+        executor=Executor(call_gpt, max_retry, async_call, cache=cache, model=CALL_GPT_MODEL, structured_output=True),
     )
     builder.add_typed_prompt(
         "summary_to_keywords",
@@ -99,7 +161,7 @@ def _build_sequence_tactic(prompt_path: Path, prompt_root: Path | None, max_retr
             input_type=ArxivSummary,
             output_type=KeyWords,
         ),
-        executor=Executor(call_gpt, max_retry),
+        executor=Executor(call_gpt, max_retry, async_call, cache=cache, model=CALL_GPT_MODEL, structured_output=True),
     )
 
     class GenerateHintInput(BaseModel):
@@ -118,14 +180,15 @@ def _build_sequence_tactic(prompt_path: Path, prompt_root: Path | None, max_retr
                 main_result=x.summary_to_description.main_result,
                 keywords=x.summary_to_keywords.keywords,
                 necessary_knowledge=x.summary_to_keywords.necessary_knowledge,
-            )
+            ),
+            reads=["title", "summary_to_description", "summary_to_keywords"],
         ),
         typed_prompt=TypedPrompt(
             load_template(Path("./llm_clis/text_to_voice/prompts/templates/arxiv_keywords_to_study_hint.j2")),
             input_type=GenerateHintInput,
             output_type=str,
         ),
-        executor=Executor(call_gpt, max_retry),
+        executor=Executor(call_gpt, max_retry, async_call, cache=cache, model=CALL_GPT_MODEL, structured_output=True),
     )
 
     current_type = builder.get_current_context_type()
@@ -142,8 +205,7 @@ def _build_sequence_tactic(prompt_path: Path, prompt_root: Path | None, max_retr
     if verbose:
         builder.show_typed_prompts()
 
-    fn = builder.build()
-    return lambda text: fn(ArxivSummary.model_validate_json(text))[0]
+    return builder.build(), ArxivSummary.model_validate_json
 
 
 @main.command()
@@ -160,6 +222,12 @@ def _build_sequence_tactic(prompt_path: Path, prompt_root: Path | None, max_retr
 @click.option("--max_retry", type=int, default=3)
 @click.option("--speaker_id", type=str, default="1")
 @click.option("--speaker_speed", type=float, default=1.5)
+@click.option("--voicevox_workers", type=int, default=1)
+@click.option("--voicevox_cache_dir", type=Path, default=DEFAULT_VOICE_CACHE_DIR)
+@click.option("--disable_voicevox_cache", is_flag=True)
+@click.option("--llm_cache_path", type=Path, default=DEFAULT_LLM_CACHE_PATH)
+@click.option("--disable_llm_cache", is_flag=True)
+@click.option("--refresh_llm_cache", is_flag=True, help="保存済みのLLMの応答を使わずに呼び直し、上書きする")
 @click.option("--verbose", is_flag=True)
 def summary_text(
     input_,
@@ -171,6 +239,12 @@ def summary_text(
     max_retry: int,
     speaker_id: str,
     speaker_speed: float,
+    voicevox_workers: int,
+    voicevox_cache_dir: Path,
+    disable_voicevox_cache: bool,
+    llm_cache_path: Path,
+    disable_llm_cache: bool,
+    refresh_llm_cache: bool,
     verbose: bool,
 ):
     if dotenv is not None:
@@ -180,17 +254,308 @@ def summary_text(
 
     input_text = input_.read()
 
-    tactic = build_tactic(tactic_name, prompt_path, prompt_root, max_retry, verbose)
+    llm_cache = None if disable_llm_cache else create_llm_cache(llm_cache_path, refresh=refresh_llm_cache)
+    tactic = build_tactic(tactic_name, prompt_path, prompt_root, max_retry, verbose, llm_cache)
 
-    description = cache_output_text(
-        lambda: tactic(input_text),
-        Path(output.parent / (output.name + ".description.txt")),
-    )
+    description = cache_output_text(lambda: tactic(input_text), description_path(output))
     if verbose:
         print(description, file=sys.stderr)
 
-    speaker = VoiceVoxSpeaker(speaker_id=speaker_id, speed=speaker_speed, url=voicevox_url)
-    text_to_wav(description, speaker, output)
+    speaker = VoiceVoxSpeaker(
+        speaker_id=speaker_id,
+        speed=speaker_speed,
+        url=voicevox_url,
+        pool_size=max(voicevox_workers, 1),
+        cache=None if disable_voicevox_cache else create_voice_cache(voicevox_cache_dir),
+    )
+    text_to_wav(description, speaker, output, max_workers=voicevox_workers)
+
+
+class LLMOptions(BaseModel):
+    """describe-dir・batchで共通の、解説文を作るためのオプション"""
+
+    tactic_name: str
+    dotenv: Optional[Path]
+    prompt_path: Path
+    prompt_root: Optional[Path]
+    max_retry: int
+    requests_per_minute: float
+    tokens_per_minute: Optional[float]
+    llm_cache_path: Path
+    disable_llm_cache: bool
+    refresh_llm_cache: bool
+
+
+def llm_options(command):
+    """LLMOptionsのオプションをコマンドに追加し、まとめてllm_options引数として渡す"""
+
+    @functools.wraps(command)
+    def wrapper(**kwargs):
+        options = LLMOptions(**{name: kwargs.pop(name) for name in LLMOptions.model_fields})
+        return command(llm_options=options, **kwargs)
+
+    options = [
+        click.option("--tactic", "tactic_name", type=str, default="single"),
+        click.option("--dotenv", type=Path),
+        click.option(
+            "--prompt_path",
+            type=Path,
+            default=Path(__file__).parent / "prompts/templates/arxiv_summary_v1.j2",
+        ),
+        click.option("--prompt_root", type=Path),
+        click.option("--max_retry", type=int, default=3),
+        click.option("--requests_per_minute", type=float, default=60),
+        click.option("--tokens_per_minute", type=float),
+        click.option("--llm_cache_path", type=Path, default=DEFAULT_LLM_CACHE_PATH),
+        click.option("--disable_llm_cache", is_flag=True),
+        click.option("--refresh_llm_cache", is_flag=True, help="保存済みのLLMの応答を使わずに呼び直し、上書きする"),
+    ]
+    for option in reversed(options):
+        wrapper = option(wrapper)
+    return wrapper
+
+
+def setup_async_tactic(options: LLMOptions, verbose: bool) -> Callable[[str], Awaitable[Any]]:
+    """環境変数を読み込み、レート制限とキャッシュを付けたasyncioのtacticを作る"""
+    if options.dotenv is not None:
+        load_dotenv(options.dotenv)
+    openai.api_key = os.environ["OPENAI_API_KEY"]
+
+    rate_limiter = RateLimiter(options.requests_per_minute, options.tokens_per_minute)
+
+    async def call(text: str, **kwargs) -> str:
+        return await call_gpt_async(text, rate_limiter=rate_limiter, **kwargs)
+
+    llm_cache = (
+        None
+        if options.disable_llm_cache
+        else create_llm_cache(options.llm_cache_path, refresh=options.refresh_llm_cache)
+    )
+    return build_async_tactic(
+        options.tactic_name, options.prompt_path, options.prompt_root, options.max_retry, verbose, call, llm_cache
+    )
+
+
+def description_path(output: Path) -> Path:
+    """summary-textの出力ファイルに対応する解説文のキャッシュ"""
+    return output.parent / (output.name + ".description.txt")
+
+
+def audio_path(input_dir: Path, output_dir: Path, input_path: Path) -> Path:
+    """input_dir/A/B.json → output_dir/A/B.mp3"""
+    relative = input_path.relative_to(input_dir)
+    return output_dir / relative.parent / (relative.stem + ".mp3")
+
+
+@main.command()
+@click.option("--input_dir", type=Path, required=True)
+@click.option("--output_dir", type=Path, required=True)
+@click.option("--pattern", type=str, default="**/*.json")
+@llm_options
+@click.option("--concurrency", type=int, default=8)
+@click.option("--verbose", is_flag=True)
+def describe_dir(
+    input_dir: Path,
+    output_dir: Path,
+    pattern: str,
+    llm_options: LLMOptions,
+    concurrency: int,
+    verbose: bool,
+):
+    """input_dir以下の要約(JSON)の解説文を1プロセスでまとめて作る。
+
+    input_dir/A/B.json の解説文は、summary-text --output output_dir/A/B.mp3 と同じキャッシュに保存する。
+    """
+    tactic = setup_async_tactic(llm_options, verbose)
+
+    async def describe(input_path: Path) -> bool:
+        output = description_path(audio_path(input_dir, output_dir, input_path))
+        if output.exists():
+            return False
+        description = await tactic(input_path.read_text())
+        output.parent.mkdir(parents=True, exist_ok=True)
+        write_text_atomic(output, description)
+        return True
+
+    async def run_all() -> list[Path]:
+        failed = []
+        skipped = 0
+        async for result in run_batch(describe, sorted(input_dir.glob(pattern)), concurrency):
+            if result.error is not None:
+                failed.append(result.key)
+                print(f"[FAILED] {result.key}: {result.error!r}", file=sys.stderr)
+            elif result.value:
+                print(f"[DONE] {result.key}", file=sys.stderr)
+            else:
+                skipped += 1
+        print(f"done: {len(failed)} failed, {skipped} skipped", file=sys.stderr)
+        return failed
+
+    failed = asyncio.run(run_all())
+    for path in failed:
+        print(path)
+    if failed:
+        sys.exit(1)
+
+
+class BatchItemReport(BaseModel):
+    input: str
+    output: str
+    status: Literal["done", "skipped", "failed"]
+    failed_stage: Optional[Literal["llm", "voicevox"]] = None
+    error: Optional[str] = None
+    llm_seconds: Optional[float] = None
+    voicevox_seconds: Optional[float] = None
+
+
+class BatchReport(BaseModel):
+    started_at: str
+    finished_at: str
+    elapsed_seconds: float
+    done: int
+    skipped: int
+    failed: int
+    items: list[BatchItemReport]
+    stages: list[StageMetrics]
+
+
+@main.command()
+@click.option("--input_dir", type=Path, required=True)
+@click.option("--output_dir", type=Path, required=True)
+@click.option("--pattern", type=str, default="**/*.json")
+@llm_options
+@click.option("--llm_concurrency", type=int, default=8)
+@click.option("--speaker_id", type=str, default="1")
+@click.option("--speaker_speed", type=float, default=1.5)
+@click.option("--voicevox_concurrency", type=int, default=1, help="同時に音声化する論文の数")
+@click.option("--voicevox_workers", type=int, default=1, help="1つの論文の音声化で並列に投げるリクエストの数")
+@click.option("--voicevox_queue_size", type=int, default=16, help="音声化を待つ解説文の数の上限")
+@click.option("--voicevox_cache_dir", type=Path, default=DEFAULT_VOICE_CACHE_DIR)
+@click.option("--disable_voicevox_cache", is_flag=True)
+@click.option("--report", type=Path, help="結果のJSONの出力先(省略時はoutput_dir/batch_report.json)")
+@click.option("--verbose", is_flag=True)
+def batch(
+    input_dir: Path,
+    output_dir: Path,
+    pattern: str,
+    llm_options: LLMOptions,
+    llm_concurrency: int,
+    speaker_id: str,
+    speaker_speed: float,
+    voicevox_concurrency: int,
+    voicevox_workers: int,
+    voicevox_queue_size: int,
+    voicevox_cache_dir: Path,
+    disable_voicevox_cache: bool,
+    report: Optional[Path],
+    verbose: bool,
+):
+    """input_dir以下の要約(JSON)をまとめて音声化する。input_dir/A/B.json → output_dir/A/B.mp3
+
+    出力済みのファイルは飛ばす。解説文の生成(LLM)と音声化(VoiceVox)は別々の同時実行数で並行に進め、
+    ある論文を音声化している間に次の論文の解説文を生成する。
+    """
+    tactic = setup_async_tactic(llm_options, verbose)
+    voicevox_url = os.environ["VOICEVOX_URL"]
+    speaker = VoiceVoxSpeaker(
+        speaker_id=speaker_id,
+        speed=speaker_speed,
+        url=voicevox_url,
+        pool_size=max(voicevox_workers * voicevox_concurrency, 1),
+        cache=None if disable_voicevox_cache else create_voice_cache(voicevox_cache_dir),
+    )
+
+    started_at = jst_now()
+    items: dict[Path, BatchItemReport] = {}
+    pending = []
+    for input_path in sorted(input_dir.glob(pattern)):
+        output = audio_path(input_dir, output_dir, input_path)
+        items[input_path] = BatchItemReport(input=str(input_path), output=str(output), status="skipped")
+        if not output.exists():
+            pending.append(input_path)
+    print(f"{len(pending)} of {len(items)} files to process", file=sys.stderr)
+
+    async def describe(input_path: Path, _) -> str:
+        start = time.monotonic()
+        output = description_path(Path(items[input_path].output))
+        if output.exists():
+            description = output.read_text()
+        else:
+            description = await tactic(input_path.read_text())
+            output.parent.mkdir(parents=True, exist_ok=True)
+            write_text_atomic(output, description)
+        items[input_path].llm_seconds = time.monotonic() - start
+        return description
+
+    async def synthesize(input_path: Path, description: str):
+        start = time.monotonic()
+        await asyncio.to_thread(
+            text_to_wav, description, speaker, Path(items[input_path].output), max_workers=voicevox_workers
+        )
+        items[input_path].voicevox_seconds = time.monotonic() - start
+
+    # 解説文は音声化の待ち行列が空くまで先に作っておき、音声化のワーカーが待たないようにする
+    pipeline = Pipeline(
+        [
+            Stage("llm", describe, llm_concurrency, queue_size=llm_concurrency),
+            Stage("voicevox", synthesize, voicevox_concurrency, queue_size=voicevox_queue_size),
+        ]
+    )
+
+    async def run_all():
+        finished = len(items) - len(pending)
+        async for result in pipeline.run(pending):
+            item = items[result.key]
+            if result.error is None:
+                item.status = "done"
+            else:
+                item.status, item.failed_stage, item.error = "failed", result.failed_stage, repr(result.error)
+            finished += 1
+            depths = ", ".join(f"{name}={depth}" for name, depth in pipeline.queue_depths().items())
+            print(f"[{finished}/{len(items)}] {item.status.upper()} {item.output} (queue: {depths})", file=sys.stderr)
+
+    asyncio.run(run_all())
+
+    finished_at = jst_now()
+    statuses = [item.status for item in items.values()]
+    batch_report = BatchReport(
+        started_at=time_json_representation(started_at),
+        finished_at=time_json_representation(finished_at),
+        elapsed_seconds=(finished_at - started_at).total_seconds(),
+        done=statuses.count("done"),
+        skipped=statuses.count("skipped"),
+        failed=statuses.count("failed"),
+        items=list(items.values()),
+        stages=pipeline.metrics,
+    )
+    report = report or output_dir / "batch_report.json"
+    report.parent.mkdir(parents=True, exist_ok=True)
+    write_text_atomic(report, batch_report.model_dump_json(indent=2))
+    print(
+        f"done: {batch_report.done} done, {batch_report.failed} failed, {batch_report.skipped} skipped "
+        f"in {batch_report.elapsed_seconds:.1f}s (report: {report})",
+        file=sys.stderr,
+    )
+    for stage in batch_report.stages:
+        print(
+            f"  {stage.name}: {stage.processed} processed, {stage.failed} failed, "
+            f"utilization {stage.utilization:.0%}, queue mean {stage.mean_queue_depth:.1f} max {stage.max_queue_depth}",
+            file=sys.stderr,
+        )
+    if batch_report.failed:
+        sys.exit(1)
+
+
+@main.command()
+@click.option("--template_root", type=Path, default=Path(__file__).parent / "prompts/templates")
+@click.option("--bytecode_cache_dir", type=Path, default=DEFAULT_TEMPLATE_BYTECODE_CACHE_DIR)
+def precompile_templates(template_root: Path, bytecode_cache_dir: Path):
+    """template_root以下の*.j2をコンパイルしてbytecode_cache_dirに保存する。
+
+    環境変数JINJA_BYTECODE_CACHE_DIRに同じディレクトリを指定すると、以降のコマンドはコンパイルせずに読み込む。
+    """
+    for name in TemplateRegistry(bytecode_cache_dir).precompile(template_root):
+        print(name)
 
 
 set_completions_command(APP_NAME, main)
@@ -1,26 +1,74 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional
 
-import httpx
 from openai import OpenAI
-from pdf2image import convert_from_path
 
+from utils.arxiv_utils import to_arxiv_id
+from utils.cache_utils import write_text_atomic
 from utils.gpt_4o_utils import run_gpt_4o, to_image_content
-from utils.voice_utils import VoiceVoxSpeaker, text_to_wav
-
-
-def download_pdf(url: str, output_path: Path):
-    if output_path.exists():
-        return output_path
-
-    # Download the PDF
-    response = httpx.get(url)
-    response.raise_for_status()
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(output_path, "wb") as f:
-        f.write(response.content)
-
-    return output_path
+from utils.llm_cache import DEFAULT_LLM_CACHE_PATH, LLMCache, create_llm_cache
+from utils.pdf_download import download_pdf, normalize_pdf_url
+from utils.pdf_pages import DEFAULT_DPI, PDFPageSource
+from utils.rate_limit import RateLimiter, openai_client
+from utils.voice_utils import DEFAULT_VOICE_CACHE_DIR, VoiceVoxSpeaker, create_voice_cache, text_to_wav
+
+
+def resolve_pdf_id(output: Path, pdf_id: str, content_hash: str, downloaded: Optional[Path] = None) -> str:
+    # 同じ内容のPDFを別のIDで処理済みなら、そちらの結果を使う。
+    # downloadedは今回ダウンロードしたPDFで、それだけを消す(pdf_idで以前に作った結果は残す)
+    hash_path = output / "by_hash" / content_hash
+    if hash_path.exists():
+        existing_id = hash_path.read_text().strip()
+        if existing_id != pdf_id and (output / existing_id).exists():
+            print(f"{pdf_id} is the same PDF as {existing_id}")
+            if downloaded is not None:
+                downloaded.unlink(missing_ok=True)
+                try:
+                    downloaded.parent.rmdir()
+                except OSError:
+                    pass
+            return existing_id
+    hash_path.parent.mkdir(parents=True, exist_ok=True)
+    write_text_atomic(hash_path, pdf_id)
+    return pdf_id
+
+
+def explain_page(
+    client: OpenAI,
+    pages: PDFPageSource,
+    page: int,
+    result_path: Path,
+    rate_limiter: RateLimiter,
+    llm_cache: Optional[LLMCache] = None,
+) -> str:
+    if result_path.exists():
+        result = result_path.read_text()
+        print(f"# {result_path}(from cache)\n{result}")
+        return result
+
+    image = pages.render(page)
+    result = run_gpt_4o(
+        client,
+        messages=[
+            {
+                "role": "system",
+                "content": "以下の論文の一部を日本語で読み上げツールで読み上げられる形式で解説してください（数式を使わない・英単語はカタカナ表記に変更する）。",
+            },
+            {
+                "role": "user",
+                "content": [to_image_content(image, "PNG")],
+            },
+        ],
+        rate_limiter=rate_limiter,
+        cache=llm_cache,
+    )
+    print(f"# {result_path}\n{result}")
+    result_path.parent.mkdir(parents=True, exist_ok=True)
+    # 中断されても書きかけの解説がキャッシュとして使われないようにする
+    write_text_atomic(result_path, result)
+    return result
 
 
 def parse_args():
@@ -28,53 +76,44 @@ def parse_args():
     parser.add_argument("--url", type=str, required=True)
     parser.add_argument("--output", type=Path, required=True)
     parser.add_argument("--disable_cache", action="store_true")
+    parser.add_argument("--dpi", type=int, default=DEFAULT_DPI)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--requests_per_minute", type=float, default=60)
+    parser.add_argument("--tokens_per_minute", type=float)
     parser.add_argument("--voicevox_url", type=str)
     parser.add_argument("--speaker_id", type=str, default="1")
     parser.add_argument("--speaker_speed", type=float, default=1.5)
+    parser.add_argument("--voicevox_workers", type=int, default=1)
+    parser.add_argument("--voicevox_cache_dir", type=Path, default=DEFAULT_VOICE_CACHE_DIR)
+    parser.add_argument("--llm_cache_path", type=Path, default=DEFAULT_LLM_CACHE_PATH)
+    parser.add_argument("--refresh_llm_cache", action="store_true")
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
-    client = OpenAI()
+    client = openai_client()
 
-    pdf_id = args.url.split("/")[-1]
-    if pdf_id.endswith(".pdf"):
-        pdf_id = pdf_id[:-4]
+    url = normalize_pdf_url(args.url)
+    pdf_id = to_arxiv_id(url).replace("/", "_")
+    pdf_path = args.output / pdf_id / f"{pdf_id}.pdf"
+    downloaded = not pdf_path.exists()
+    content_hash = download_pdf(url, pdf_path)
+    pdf_id = resolve_pdf_id(args.output, pdf_id, content_hash, pdf_path if downloaded else None)
 
     output_root = args.output / pdf_id
-    output_pdf = output_root / f"{pdf_id}.pdf"
-
-    output_path = download_pdf(args.url, output_pdf)
-    pdf_images = convert_from_path(output_path)
-
-    results = []
-    for i, page in enumerate(pdf_images, start=1):
-        result_path = output_root / "summary" / f"{i}.txt"
-        if result_path.exists():
-            print(f"# {result_path}(from cache)")
-            result = result_path.read_text()
-            results.append(result)
-            print(result)
-            continue
-        result = run_gpt_4o(
-            client,
-            messages=[
-                {
-                    "role": "system",
-                    "content": "以下の論文の一部を日本語で読み上げツールで読み上げられる形式で解説してください（数式を使わない・英単語はカタカナ表記に変更する）。",
-                },
-                {
-                    "role": "user",
-                    "content": [to_image_content(page, "PNG")],
-                },
-            ],
-        )
-        print(f"# {result_path}")
-        results.append(result)
-        print(result)
-        result_path.parent.mkdir(parents=True, exist_ok=True)
-        result_path.write_text(result)
+    pages = PDFPageSource(output_root / f"{pdf_id}.pdf", dpi=args.dpi, cache_dir=output_root / "pages" / str(args.dpi))
+
+    rate_limiter = RateLimiter(args.requests_per_minute, args.tokens_per_minute)
+    llm_cache = None if args.disable_cache else create_llm_cache(args.llm_cache_path, refresh=args.refresh_llm_cache)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [
+            executor.submit(
+                explain_page, client, pages, i, output_root / "summary" / f"{i}.txt", rate_limiter, llm_cache
+            )
+            for i in range(1, len(pages) + 1)
+        ]
+        results = [future.result() for future in futures]
     all_result = "\n".join(results)
 
     output = output_root / "summary.txt"
@@ -82,8 +121,14 @@ def main():
     print("writing to", output)
     output.write_text(all_result)
 
-    speaker = VoiceVoxSpeaker(speaker_id=args.speaker_id, speed=args.speaker_speed, url=args.voicevox_url)
-    text_to_wav(all_result, speaker, output_root / f"{pdf_id}.mp3")
+    speaker = VoiceVoxSpeaker(
+        speaker_id=args.speaker_id,
+        speed=args.speaker_speed,
+        url=args.voicevox_url,
+        pool_size=max(args.voicevox_workers, 1),
+        cache=None if args.disable_cache else create_voice_cache(args.voicevox_cache_dir),
+    )
+    text_to_wav(all_result, speaker, output_root / f"{pdf_id}.mp3", max_workers=args.voicevox_workers)
     print("done!")
 
 
@@ -1,32 +1,91 @@
+import asyncio
 import json
+import os
+import shutil
 import sys
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from pathlib import Path
-from uuid import uuid4
+from typing import AsyncIterator, BinaryIO, Optional
 
 import fastapi
-import httpx
-import openai
 from dotenv import load_dotenv
 from fastapi.staticfiles import StaticFiles
-from pdf2image import convert_from_path
-from PIL import Image
 from pydantic import BaseModel
 
-from utils.gpt_4o_utils import run_gpt_4o, to_image_content
-from utils.voice_utils import VoiceVoxSpeaker, text_to_wav
+from utils.cache_utils import temp_path_for, write_text_atomic
+from utils.document_index import DocumentIndex, DocumentRecord
+from utils.gpt_4o_utils import file_to_image_content, stream_gpt_4o_async
+from utils.job_queue import Job, JobQueue
+from utils.pdf_download import download_pdf, normalize_pdf_url
+from utils.pdf_pages import DEFAULT_DPI, PDFPageSource
+from utils.rate_limit import async_openai_client
+from utils.task_utils import KeyedTaskPool, SingleFlight, TextBroadcast, run_in_executor
+from utils.voice_utils import VoiceVoxSpeaker, create_voice_cache, text_to_audio_stream
 
 tmp = Path("_tmp/pdf_updown")
 
+
+@asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+
+
 load_dotenv()
-app = fastapi.FastAPI()
-client = openai.Client()
-url_to_request_id_path = tmp / "url_to_request_id.json"
-if url_to_request_id_path.exists():
-    url_to_request_id = json.loads(url_to_request_id_path.read_text())
-else:
-    url_to_request_id = {}
-    url_to_request_id_path.parent.mkdir(parents=True, exist_ok=True)
-    url_to_request_id_path.write_text(json.dumps(url_to_request_id))
+app = fastapi.FastAPI(lifespan=lifespan)
+client = async_openai_client()
+# URL→request_idの対応と、文書ごとのページ数・解説/音声のあるページ
+documents = DocumentIndex(tmp / "documents.sqlite3")
+RENDER_DPI = DEFAULT_DPI
+
+
+def _migrate_url_to_request_id(json_path: Path):
+    # 以前の url_to_request_id.json の対応を取り込む。ページの情報は /init/ で初めて開いたときに埋める
+    if json_path.exists():
+        for url, request_id in json.loads(json_path.read_text()).items():
+            documents.get_or_create(normalize_pdf_url(url), request_id, aliases=[url])
+        json_path.rename(json_path.with_name(json_path.name + ".migrated"))
+
+
+_migrate_url_to_request_id(tmp / "url_to_request_id.json")
+
+
+# ブロッキング処理はFastAPIのスレッドプールではなく専用のスレッドで行い、軽いエンドポイントを詰まらせない。
+# ページ描画はpdftoppmのプロセスが行う
+RENDER_WORKERS = 4
+render_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+TTS_JOBS = 4
+tts_executor = ThreadPoolExecutor(max_workers=TTS_JOBS, thread_name_prefix="tts")
+
+_page_sources: dict[str, PDFPageSource] = {}
+_page_sources_lock = threading.Lock()
+
+
+def get_page_source(request_id: str) -> PDFPageSource:
+    # ページの二重描画を防ぐため、request_idごとに同じインスタンスを使う
+    with _page_sources_lock:
+        if request_id not in _page_sources:
+            work_dir = tmp / request_id
+            doc = documents.get(request_id)
+            _page_sources[request_id] = PDFPageSource(
+                work_dir / "pdf.pdf",
+                dpi=doc.dpi or RENDER_DPI if doc else RENDER_DPI,
+                cache_dir=work_dir / "images",
+                page_count=doc.page_count if doc else None,
+            )
+        return _page_sources[request_id]
+
+
+def get_page_image_path(request_id: str, page: int) -> Path:
+    try:
+        return get_page_source(request_id).ensure_rendered(page)
+    except IndexError as e:
+        raise fastapi.HTTPException(status_code=404, detail=str(e)) from e
 
 
 app.mount("/static", StaticFiles(directory="./webui/llm_app_ui/dist"), name="static")
@@ -46,31 +105,85 @@ class InitRequest(BaseModel):
 class InitResponse(BaseModel):
     request_id: str
     page_num: int
-
-
-@app.post("/init/")
-def init(req: InitRequest) -> InitResponse:
-    if req.url in url_to_request_id:
-        request_id = url_to_request_id[req.url]
-    else:
-        request_id = str(uuid4())
-        url_to_request_id[req.url] = request_id
-        url_to_request_id_path.parent.mkdir(parents=True, exist_ok=True)
-        url_to_request_id_path.write_text(json.dumps(url_to_request_id))
+    explained_pages: list[int] = []
+    audio_pages: list[int] = []
+
+
+def _scan_pages(request_id: str):
+    # インデックスより前に作られた解説・音声を登録する。文書ごとに初回の /init/ でだけ行う
+    for path in (tmp / request_id).glob("explain_*.txt"):
+        documents.mark_page(request_id, int(path.stem.removeprefix("explain_")), explanation=True)
+    for path in (tmp / request_id).glob("explain_*.mp3"):
+        documents.mark_page(request_id, int(path.stem.removeprefix("explain_")), audio=True)
+
+
+def _merge_outputs(src_id: str, dst_id: str):
+    # 同じPDFを別のrequest_idで開いたときに、src_idで作った解説・音声(移行前の文書など)をdst_idへ移す。
+    # dst_idに解説があるページは移さずに残す。PDFと描画した画像は作り直せるので消す
+    src_dir, dst_dir = tmp / src_id, tmp / dst_id
+    dst_dir.mkdir(parents=True, exist_ok=True)
+    for text_path in src_dir.glob("explain_*.txt"):
+        if (dst_dir / text_path.name).exists():
+            continue
+        audio_path = text_path.with_suffix(".mp3")
+        if audio_path.exists():
+            os.replace(audio_path, dst_dir / audio_path.name)
+        os.replace(text_path, dst_dir / text_path.name)
+    (src_dir / "pdf.pdf").unlink(missing_ok=True)
+    shutil.rmtree(src_dir / "images", ignore_errors=True)
+    try:
+        src_dir.rmdir()
+    except OSError:
+        print(f"[WARN] {src_dir} is kept because it has outputs that conflict with {dst_id}", file=sys.stderr)
+    _scan_pages(dst_id)
+
+
+async def _prepare_document(url: str, request_id: str) -> DocumentRecord:
     work_dir = tmp / request_id
-    image_dir = work_dir / "images"
     pdf_path = work_dir / "pdf.pdf"
-    work_dir.mkdir(parents=True, exist_ok=True)
-    image_dir.mkdir(parents=True, exist_ok=True)
     if not pdf_path.exists():
-        print(f"[INFO] Download PDF from {req.url}", sys.stderr)
-        pdf_path.write_bytes(httpx.get(req.url).content)
-    pages = convert_from_path(pdf_path)
-    for i, page in enumerate(pages, start=1):
-        if not (image_dir / f"{i:04d}.png").exists():
-            page.save(image_dir / f"{i:04d}.png")
+        print(f"[INFO] Download PDF from {url}", file=sys.stderr)
+    content_hash = await asyncio.to_thread(download_pdf, url, pdf_path)
+    doc = documents.set_content_hash(request_id, content_hash)
+    if doc.request_id != request_id:
+        # 別のURLで同じPDFを処理済み。こちらで作った解説・音声はそちらへ移し、以降はそちらを使う
+        print(f"[INFO] {url} is the same PDF as {doc.url}", file=sys.stderr)
+        with _page_sources_lock:
+            _page_sources.pop(request_id, None)
+        await asyncio.to_thread(_merge_outputs, request_id, doc.request_id)
+        request_id = doc.request_id
+        doc = documents.get(request_id)
+        assert doc is not None
+        if doc.page_count is not None:
+            return doc
+
+    # ページ数はPDFのメタデータから取得し、画像は /image/ で要求されたときに描画する
+    page_source = get_page_source(request_id)
+    page_count = await run_in_executor(render_executor, lambda: page_source.page_count)
+    await asyncio.to_thread(_scan_pages, request_id)
+    documents.set_page_count(request_id, page_count, page_source.dpi)
+    doc = documents.get(request_id)
+    assert doc is not None
+    return doc
+
 
-    return InitResponse(request_id=request_id, page_num=len(pages))
+@app.post("/init/")
+async def init(req: InitRequest) -> InitResponse:
+    # arXivの /abs/ と /pdf/ などは同じURLとして扱う
+    # 正規化する前のURLで登録された文書(移行前のものなど)も引けるようにする
+    url = normalize_pdf_url(req.url)
+    doc = documents.get_or_create(url, aliases=[req.url])
+    if doc.page_count is None:
+        # PDFの取得とページ数の取得は初回だけ。2回目以降はインデックスだけで答える
+        doc = await flights.do(("init", doc.request_id), _prepare_document, url, doc.request_id)
+        assert doc.page_count is not None
+
+    return InitResponse(
+        request_id=doc.request_id,
+        page_num=doc.page_count,
+        explained_pages=doc.explained_pages,
+        audio_pages=doc.audio_pages,
+    )
 
 
 class ImageRequest(BaseModel):
@@ -79,10 +192,9 @@ class ImageRequest(BaseModel):
 
 
 @app.post("/image/")
-def image(req: ImageRequest) -> fastapi.responses.FileResponse:
+async def image(req: ImageRequest) -> fastapi.responses.FileResponse:
     # 画像を返す
-    work_dir = tmp / req.request_id
-    image_path = work_dir / "images" / f"{req.page:04d}.png"
+    image_path = await run_in_executor(render_executor, get_page_image_path, req.request_id, req.page)
     return fastapi.responses.FileResponse(image_path)
 
 
@@ -93,36 +205,192 @@ class ExplainRequest(BaseModel):
 
 class ExplainResponse(BaseModel):
     explanation: str
+    audio_job_id: Optional[str] = None
 
 
+# 1ページの合成でVOICEVOX_WORKERS件ずつ並列に投げる。TTS_JOBSページ分が同時に走っても、
+# エンジンへの同時リクエストはVOICEVOX_CONCURRENCYまで(接続プールも同じ大きさ)
+VOICEVOX_WORKERS = 2
+VOICEVOX_CONCURRENCY = 4
 speaker = VoiceVoxSpeaker(
     speaker_id="1",
     speed=1.5,
     volume=4,
     url="http://localhost:50021",
+    pool_size=VOICEVOX_CONCURRENCY,
+    cache=create_voice_cache(tmp / "voicevox_cache"),
 )
 
+# ページNが要求されたら、N+1..N+PREFETCH_PAGESの解説と音声を裏で作っておく
+PREFETCH_PAGES = 3
+PREFETCH_WORKERS = 2
+prefetcher = KeyedTaskPool(max_concurrency=PREFETCH_WORKERS)
+# 同じページの解説・音声の生成が同時に走らないよう、先読みも含めてキーごとに一つにまとめる
+flights = SingleFlight()
 
-@app.post("/explain/")
-def explain(req: ExplainRequest) -> ExplainResponse:
-    cache_path = tmp / req.request_id / f"explain_{req.page:04d}.txt"
+
+# ページごとの解説("explain")・音声("audio")の生成は、それぞれのロックで一つずつ行う。
+# 再生成は両方を取り、再生成の前から待っていた音声合成が古い解説から作った音声を残さないようにする
+_page_locks: "weakref.WeakValueDictionary[tuple[str, str, int], asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def page_lock(kind: str, request_id: str, page: int) -> asyncio.Lock:
+    lock = _page_locks.get((kind, request_id, page))
+    if lock is None:
+        lock = _page_locks[(kind, request_id, page)] = asyncio.Lock()
+    return lock
+
+
+# 生成中の解説。/explain_stream/ はここから届いた分を配信する
+_explanation_streams: dict[tuple[str, int], TextBroadcast] = {}
+
+
+async def _ensure_explanation(request_id: str, page: int) -> str:
+    cache_path = tmp / request_id / f"explain_{page:04d}.txt"
     if cache_path.exists():
-        return ExplainResponse(explanation=cache_path.read_text())
+        return cache_path.read_text()
+    async with page_lock("explain", request_id, page):
+        if cache_path.exists():
+            return cache_path.read_text()
+        broadcast = _explanation_streams[(request_id, page)] = TextBroadcast()
+        try:
+            image_path = await run_in_executor(render_executor, get_page_image_path, request_id, page)
+            async for chunk in iter_explanation(image_path):
+                broadcast.append(chunk)
+        finally:
+            broadcast.close()
+            del _explanation_streams[(request_id, page)]
+        explanation = broadcast.text
+        await asyncio.to_thread(write_text_atomic, cache_path, explanation)
+        documents.mark_page(request_id, page, explanation=True)
+        return explanation
+
+
+# 合成中の音声の書き込み先。/audio_stream/ はここを読んで、合成が終わるのを待たずに配信する
+_audio_parts: dict[tuple[str, int], Path] = {}
+
+
+async def _ensure_audio(request_id: str, page: int) -> Path:
+    audio_path = tmp / request_id / f"explain_{page:04d}.mp3"
+    if audio_path.exists():
+        return audio_path
+    async with page_lock("audio", request_id, page):
+        if audio_path.exists():
+            return audio_path
+        explanation = (tmp / request_id / f"explain_{page:04d}.txt").read_text()
+        part_path = temp_path_for(audio_path)
+        _audio_parts[(request_id, page)] = part_path
+        try:
+            chunks = text_to_audio_stream(
+                explanation, speaker, "mp3", output=audio_path, max_workers=VOICEVOX_WORKERS, part_path=part_path
+            )
+            await run_in_executor(tts_executor, deque, chunks, maxlen=0)
+        finally:
+            del _audio_parts[(request_id, page)]
+        documents.mark_page(request_id, page, audio=True)
+    return audio_path
+
+
+async def ensure_explanation(request_id: str, page: int) -> str:
+    return await flights.do(("explain", request_id, page), _ensure_explanation, request_id, page)
+
+
+def start_audio(request_id: str, page: int) -> asyncio.Task:
+    return flights.start(("audio", request_id, page), _ensure_audio, request_id, page)
+
+
+async def ensure_audio(request_id: str, page: int) -> Path:
+    return await asyncio.shield(start_audio(request_id, page))
+
+
+# 音声合成は永続ジョブとして積み、/explain/ は解説文ができた時点で返す。再起動しても未完了のジョブは再開する
+AUDIO_JOB_WORKERS = 2
+job_queue = JobQueue(tmp / "jobs.sqlite3", max_concurrency=AUDIO_JOB_WORKERS)
+job_queue.register("audio", ensure_audio)
+
+
+def enqueue_audio_job(request_id: str, page: int) -> Optional[str]:
+    if documents.has_audio(request_id, page):
+        return None
+    job = job_queue.enqueue("audio", f"audio:{request_id}:{page}", {"request_id": request_id, "page": page})
+    return job.job_id
+
+
+async def _prefetch_explanation(request_id: str, page: int):
+    await ensure_explanation(request_id, page)
+    prefetcher.submit(request_id, ("audio", request_id, page), ensure_audio, request_id, page)
+
+
+async def schedule_prefetch(request_id: str, page: int):
+    # 読者が移動して範囲外になったページの待ちタスクは取り消す
+    doc = documents.get(request_id)
+    if doc is None or doc.page_count is None:
+        return
+    pages = range(page + 1, min(page + PREFETCH_PAGES, doc.page_count) + 1)
+    keys = {(kind, request_id, p) for kind in ("explain", "audio") for p in pages}
+    prefetcher.cancel_group(request_id, keep=keys)
+    audio_pages = set(doc.audio_pages)
+    for p in pages:
+        if p not in audio_pages:
+            prefetcher.submit(request_id, ("explain", request_id, p), _prefetch_explanation, request_id, p)
 
-    image_path = tmp / req.request_id / "images" / f"{req.page:04d}.png"
-    explanation = generate_explanation(image_path)
-    cache_path.write_text(explanation)
-    audio_path = tmp / req.request_id / f"explain_{req.page:04d}.mp3"
-    text_to_wav(explanation, speaker, audio_path)
 
-    return ExplainResponse(explanation=explanation)
+@app.post("/explain/")
+async def explain(req: ExplainRequest) -> ExplainResponse:
+    await schedule_prefetch(req.request_id, req.page)
+    # 順番待ちの先読みは取り消してすぐに生成する。実行中ならflightsがその結果を共有する
+    prefetcher.cancel_pending(("explain", req.request_id, req.page))
+    explanation = await ensure_explanation(req.request_id, req.page)
+
+    return ExplainResponse(explanation=explanation, audio_job_id=enqueue_audio_job(req.request_id, req.page))
 
 
-def generate_explanation(image_path):
-    image = Image.open(image_path)
-    image_type = "png"
-    image_content = to_image_content(image, image_type)
-    response = run_gpt_4o(
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.get("/explain_stream/")
+async def explain_stream(request_id: str, page: int) -> fastapi.responses.StreamingResponse:
+    # /explain/ のServer-Sent Events版。生成された断片を delta イベントで順に送り、最後に done イベントを送る
+    await schedule_prefetch(request_id, page)
+    prefetcher.cancel_pending(("explain", request_id, page))
+    task = flights.start(("explain", request_id, page), _ensure_explanation, request_id, page)
+    return fastapi.responses.StreamingResponse(
+        _explanation_events(request_id, page, task),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+async def _explanation_events(request_id: str, page: int, task: asyncio.Task) -> AsyncIterator[str]:
+    # 始めたばかりのタスクが _explanation_streams に登録するまで一度譲る
+    await asyncio.sleep(0)
+    broadcast = _explanation_streams.get((request_id, page))
+    if broadcast is not None:
+        async for chunk in broadcast.iter_chunks():
+            yield _sse("delta", {"text": chunk})
+    try:
+        explanation = await asyncio.shield(task)
+    except Exception as e:
+        yield _sse("error", {"detail": repr(e)})
+        return
+    if broadcast is None:
+        # 生成済みだったので、まとめて送る
+        yield _sse("delta", {"text": explanation})
+    yield _sse("done", {"explanation": explanation, "audio_job_id": enqueue_audio_job(request_id, page)})
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str) -> Job:
+    job = job_queue.get(job_id)
+    if job is None:
+        raise fastapi.HTTPException(status_code=404, detail=f"job {job_id} is not found")
+    return job
+
+
+async def iter_explanation(image_path: Path) -> AsyncIterator[str]:
+    image_content = await asyncio.to_thread(file_to_image_content, image_path, "png")
+    stream = stream_gpt_4o_async(
         client,
         messages=[
             {
@@ -136,29 +404,91 @@ def generate_explanation(image_path):
                 ],
             }
         ],
-        json_mode=False,
         model="gpt-4o-mini",
     )
-    return response
+    async for chunk in stream:
+        yield chunk
+
+
+async def generate_explanation(image_path: Path) -> str:
+    return "".join([chunk async for chunk in iter_explanation(image_path)])
 
 
 @app.post("/audio/")
-def audio(req: ExplainRequest) -> fastapi.responses.FileResponse:
-    audio_path = tmp / req.request_id / f"explain_{req.page:04d}.mp3"
-    if not audio_path.exists():
-        explanation_path = tmp / req.request_id / f"explain_{req.page:04d}.txt"
-        explanation = explanation_path.read_text()
-        text_to_wav(explanation, speaker, audio_path)
+async def audio(req: ExplainRequest) -> fastapi.responses.FileResponse:
+    prefetcher.cancel_pending(("audio", req.request_id, req.page))
+    audio_path = await ensure_audio(req.request_id, req.page)
     return fastapi.responses.FileResponse(audio_path)
 
 
+@app.get("/audio_stream/")
+async def audio_stream(request_id: str, page: int) -> fastapi.responses.Response:
+    # 合成済みならファイルを返し(Range対応)、未合成なら合成を始めて(合成中なら相乗りして)書き込まれた分から配信する
+    prefetcher.cancel_pending(("audio", request_id, page))
+    audio_path = tmp / request_id / f"explain_{page:04d}.mp3"
+    if audio_path.exists():
+        return fastapi.responses.FileResponse(audio_path, media_type="audio/mpeg")
+    task = start_audio(request_id, page)
+    f_in = await _open_audio(request_id, page, task)
+    if f_in is None:
+        # 書き込みが始まる前に終わった。失敗していればその例外で /audio/ と同じくエラーを返す
+        return fastapi.responses.FileResponse(await asyncio.shield(task), media_type="audio/mpeg")
+    return fastapi.responses.StreamingResponse(_tail_audio(f_in, task), media_type="audio/mpeg")
+
+
+async def _open_audio(request_id: str, page: int, task: asyncio.Task) -> Optional[BinaryIO]:
+    # 書き込み中のファイルを、最初の音声が書かれてから開く。
+    # 開いた後で完成版に置き換えられても、同じファイルを読み続けられる。書き込みが始まる前にtaskが終わったらNone
+    audio_path = tmp / request_id / f"explain_{page:04d}.mp3"
+    while True:
+        for path in [_audio_parts.get((request_id, page)), audio_path]:
+            if path is None:
+                continue
+            try:
+                f_in = path.open("rb")
+            except FileNotFoundError:
+                continue
+            if os.fstat(f_in.fileno()).st_size > 0:
+                return f_in
+            f_in.close()
+        if task.done():
+            return None
+        await asyncio.sleep(0.05)
+
+
+async def _tail_audio(f_in: BinaryIO, task: asyncio.Task, chunk_size: int = 64 * 1024):
+    with f_in:
+        while True:
+            done = task.done()
+            chunk = f_in.read(chunk_size)
+            if chunk:
+                yield chunk
+            elif done:
+                break
+            else:
+                await asyncio.sleep(0.1)
+    # 配信を始めた後ではステータスを変えられないので、途中で失敗したら記録して打ち切る
+    error = None if task.cancelled() else task.exception()
+    if error is not None:
+        print(f"[WARN] Audio synthesis failed while streaming: {error!r}", file=sys.stderr)
+
+
+async def _regenerate(request_id: str, page: int) -> str:
+    for kind in ("explain", "audio"):
+        prefetcher.cancel_pending((kind, request_id, page))
+    # 生成中の解説・音声は終わるのを待ち、これから始まるものは新しい解説ができてから行う
+    async with page_lock("explain", request_id, page), page_lock("audio", request_id, page):
+        image_path = await run_in_executor(render_executor, get_page_image_path, request_id, page)
+        explanation = await generate_explanation(image_path)
+        cache_path = tmp / request_id / f"explain_{page:04d}.txt"
+        await asyncio.to_thread(write_text_atomic, cache_path, explanation)
+        audio_path = tmp / request_id / f"explain_{page:04d}.mp3"
+        audio_path.unlink(missing_ok=True)
+        documents.mark_page(request_id, page, explanation=True, audio=False)
+    return explanation
+
+
 @app.post("/regenerate/")
-def regenerate(req: ExplainRequest) -> ExplainResponse:
-    image_path = tmp / req.request_id / "images" / f"{req.page:04d}.png"
-    explanation = generate_explanation(image_path)
-    cache_path = tmp / req.request_id / f"explain_{req.page:04d}.txt"
-    cache_path.write_text(explanation)
-    audio_path = tmp / req.request_id / f"explain_{req.page:04d}.mp3"
-    text_to_wav(explanation, speaker, audio_path)
-
-    return ExplainResponse(explanation=explanation)
+async def regenerate(req: ExplainRequest) -> ExplainResponse:
+    explanation = await flights.do(("regenerate", req.request_id, req.page), _regenerate, req.request_id, req.page)
+    return ExplainResponse(explanation=explanation, audio_job_id=enqueue_audio_job(req.request_id, req.page))
@@ -2,6 +2,7 @@ from functools import cached_property
 from typing import Dict, Sequence, TypeVar, Generic, Callable, Optional, List, Literal
 from datetime import datetime
 from pathlib import Path
+from urllib.parse import urlparse
 import yaml
 from pydantic import BaseModel
 import arxiv
@@ -149,7 +150,14 @@ class UpdateTimeStopCondition:
 
 
 def to_arxiv_id(url):
-    id_ = [x for x in url.split("/") if x != ""][-1]
+    path = urlparse(url).path
+    # /abs/hep-th/9901001 のような旧形式のIDはスラッシュを含む
+    for prefix in ("/abs/", "/pdf/"):
+        if prefix in path:
+            id_ = path.split(prefix, 1)[1].strip("/")
+            break
+    else:
+        id_ = [x for x in path.split("/") if x != ""][-1]
     if id_.endswith(".pdf"):
         id_ = id_[:-4]
     return id_
@@ -1,5 +1,26 @@
+import os
+import threading
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Optional
+
+
+def temp_path_for(path: Path) -> Path:
+    """pathと同じディレクトリに置く一時ファイルのパス。書き終えてからos.replaceでpathに移す。"""
+    return path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def write_bytes_atomic(path: Path, data: bytes):
+    """書きかけのファイルが読まれないよう、一時ファイルに書いてから置き換える。"""
+    tmp_path = temp_path_for(path)
+    try:
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def write_text_atomic(path: Path, text: str):
+    write_bytes_atomic(path, text.encode("utf-8"))
 
 
 def cache_output_text(fn: Callable[[], str], path: Path):
@@ -8,5 +29,76 @@ def cache_output_text(fn: Callable[[], str], path: Path):
     else:
         result = fn()
         path.parent.mkdir(parents=True, exist_ok=True)
-        path.write_text(result)
+        write_text_atomic(path, result)
         return result
+
+
+# 上限を超えたら上限のこの割合まで削除する。上限ちょうどまでだと、満杯の間はputのたびに削除(全体の走査)が走る
+EVICT_TO_RATIO = 0.9
+
+
+class DiskLRUCache:
+    """バイト列をキーごとにファイルで保存するキャッシュ。
+
+    合計サイズがmax_bytesを超えたら、最終アクセス(mtime)が古いものからmax_bytesのEVICT_TO_RATIOまで削除する。
+    """
+
+    def __init__(self, root: Path, max_bytes: int, suffix: str = ""):
+        self.__root = root
+        self.__max_bytes = max_bytes
+        self.__suffix = suffix
+        self.__lock = threading.Lock()
+        self.__total_bytes: Optional[int] = None
+
+    def _path(self, key: str) -> Path:
+        return self.__root / key[:2] / f"{key}{self.__suffix}"
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, key: str, data: bytes):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            old_size = path.stat().st_size
+        except FileNotFoundError:
+            old_size = 0
+        write_bytes_atomic(path, data)
+        with self.__lock:
+            if self.__total_bytes is None:
+                self.__total_bytes = sum(size for _, _, size in self._entries())
+            else:
+                self.__total_bytes += len(data) - old_size
+            if self.__total_bytes > self.__max_bytes:
+                self._evict()
+
+    def _entries(self) -> list[tuple[float, Path, int]]:
+        entries = []
+        for path in self.__root.glob(f"*/*{self.__suffix}"):
+            if path.name.startswith("."):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[0])
+        total = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if total <= self.__max_bytes * EVICT_TO_RATIO:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+        self.__total_bytes = total
@@ -0,0 +1,58 @@
+import tempfile
+import time
+from pathlib import Path
+from unittest import TestCase, main
+
+from utils.cache_utils import DiskLRUCache
+
+
+class DiskLRUCacheTest(TestCase):
+    def setUp(self):
+        self.__tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.__tmp.name)
+
+    def tearDown(self):
+        self.__tmp.cleanup()
+
+    def test_get_put(self):
+        cache = DiskLRUCache(self.root, max_bytes=100, suffix=".bin")
+        self.assertIsNone(cache.get("aa"))
+        cache.put("aa", b"data")
+        self.assertEqual(cache.get("aa"), b"data")
+        self.assertEqual(DiskLRUCache(self.root, max_bytes=100, suffix=".bin").get("aa"), b"data")
+
+    def test_evicts_least_recently_used(self):
+        cache = DiskLRUCache(self.root, max_bytes=10)
+        cache.put("a", b"1234")
+        time.sleep(0.01)
+        cache.put("b", b"1234")
+        time.sleep(0.01)
+        cache.get("a")
+        time.sleep(0.01)
+        cache.put("c", b"1234")
+        self.assertEqual(cache.get("a"), b"1234")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), b"1234")
+
+    def test_evicts_below_max_bytes(self):
+        # 上限を超えたら上限の9割まで消すので、続くputでは削除が起きない
+        cache = DiskLRUCache(self.root, max_bytes=100)
+        for i in range(11):
+            cache.put(f"k{i:02d}", b"0123456789")
+            time.sleep(0.01)
+        self.assertEqual([cache.get(f"k{i:02d}") is not None for i in range(11)], [False] * 2 + [True] * 9)
+        cache.put("k11", b"0123456789")
+        self.assertEqual(sum(cache.get(f"k{i:02d}") is not None for i in range(12)), 10)
+
+    def test_overwrite_is_not_counted_twice(self):
+        cache = DiskLRUCache(self.root, max_bytes=10)
+        cache.put("a", b"12345678")
+        time.sleep(0.01)
+        for _ in range(5):
+            cache.put("b", b"12")
+        self.assertEqual(cache.get("a"), b"12345678")
+        self.assertEqual(cache.get("b"), b"12")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Iterable, Optional
+from uuid import uuid4
+
+from pydantic import BaseModel
+
+from utils.time_utils import jst_now, time_json_representation
+
+
+class DocumentRecord(BaseModel):
+    request_id: str
+    url: str
+    page_count: Optional[int] = None
+    dpi: Optional[int] = None
+    content_hash: Optional[str] = None
+    explained_pages: list[int] = []
+    audio_pages: list[int] = []
+    created_at: str
+    updated_at: str
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    request_id TEXT PRIMARY KEY,
+    url TEXT NOT NULL UNIQUE,
+    page_count INTEGER,
+    dpi INTEGER,
+    content_hash TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS url_aliases (
+    url TEXT PRIMARY KEY,
+    request_id TEXT NOT NULL REFERENCES documents (request_id)
+);
+CREATE TABLE IF NOT EXISTS pages (
+    request_id TEXT NOT NULL REFERENCES documents (request_id),
+    page INTEGER NOT NULL,
+    has_explanation INTEGER NOT NULL DEFAULT 0,
+    has_audio INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (request_id, page)
+);
+"""
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS documents_content_hash ON documents (content_hash);
+"""
+
+
+class DocumentIndex:
+    """URL→request_idの対応と、文書ごとのメタデータ(ページ数・DPI・解説/音声のあるページ)をSQLiteに保存する。
+
+    内容(sha256)が同じ文書は1つにまとめ、後から登録されたURLは既存の文書の別名にする。
+    書き込みは1件ずつトランザクションで行うので、同時に呼ばれても登録が失われることはない。
+    複数スレッドから使ってよい。
+    """
+
+    def __init__(self, db_path: Path):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.__db = sqlite3.connect(db_path, check_same_thread=False)
+        self.__db.row_factory = sqlite3.Row
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.executescript(_SCHEMA)
+        columns = {row["name"] for row in self.__db.execute("PRAGMA table_info(documents)")}
+        if "content_hash" not in columns:
+            self.__db.execute("ALTER TABLE documents ADD COLUMN content_hash TEXT")
+        self.__db.executescript(_INDEXES)
+        self.__lock = threading.Lock()
+
+    def get_or_create(self, url: str, request_id: Optional[str] = None, aliases: Iterable[str] = ()) -> DocumentRecord:
+        """urlの文書を返す。未登録ならrequest_id(省略時は新しいUUID)で登録する。
+
+        aliases(正規化する前のURLなど)で登録済みの文書があれば、urlをその文書の別名にして返す。
+        """
+        now = time_json_representation(jst_now())
+        with self.__lock, self.__db:
+            row = self._find(url)
+            if row is None:
+                for alias in aliases:
+                    row = self._find(alias)
+                    if row is not None:
+                        self.__db.execute("INSERT OR IGNORE INTO url_aliases VALUES (?, ?)", (url, row["request_id"]))
+                        break
+            if row is None:
+                self.__db.execute(
+                    "INSERT OR IGNORE INTO documents (request_id, url, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                    (request_id or str(uuid4()), url, now, now),
+                )
+                row = self._find(url)
+        record = self.get(row["request_id"])
+        assert record is not None
+        return record
+
+    def _find(self, url: str) -> Optional[sqlite3.Row]:
+        row = self.__db.execute("SELECT request_id FROM url_aliases WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            row = self.__db.execute("SELECT request_id FROM documents WHERE url = ?", (url,)).fetchone()
+        return row
+
+    def get(self, request_id: str) -> Optional[DocumentRecord]:
+        with self.__lock:
+            row = self.__db.execute("SELECT * FROM documents WHERE request_id = ?", (request_id,)).fetchone()
+            if row is None:
+                return None
+            pages = self.__db.execute(
+                "SELECT page, has_explanation, has_audio FROM pages WHERE request_id = ? ORDER BY page", (request_id,)
+            ).fetchall()
+        return DocumentRecord(
+            **dict(row),
+            explained_pages=[p["page"] for p in pages if p["has_explanation"]],
+            audio_pages=[p["page"] for p in pages if p["has_audio"]],
+        )
+
+    def set_page_count(self, request_id: str, page_count: int, dpi: int):
+        with self.__lock, self.__db:
+            self.__db.execute(
+                "UPDATE documents SET page_count = ?, dpi = ?, updated_at = ? WHERE request_id = ?",
+                (page_count, dpi, time_json_representation(jst_now()), request_id),
+            )
+
+    def set_content_hash(self, request_id: str, content_hash: str) -> DocumentRecord:
+        """文書の内容のハッシュを記録する。
+
+        同じ内容の文書が既にあれば、request_idの文書を消してそのURLを既存の文書の別名にし、既存の文書を返す。
+        """
+        with self.__lock, self.__db:
+            row = self.__db.execute(
+                "SELECT request_id FROM documents WHERE content_hash = ? AND request_id != ?",
+                (content_hash, request_id),
+            ).fetchone()
+            if row is None:
+                self.__db.execute(
+                    "UPDATE documents SET content_hash = ?, updated_at = ? WHERE request_id = ?",
+                    (content_hash, time_json_representation(jst_now()), request_id),
+                )
+                canonical_id = request_id
+            else:
+                canonical_id = row["request_id"]
+                (url,) = self.__db.execute("SELECT url FROM documents WHERE request_id = ?", (request_id,)).fetchone()
+                self.__db.execute("DELETE FROM pages WHERE request_id = ?", (request_id,))
+                self.__db.execute("DELETE FROM documents WHERE request_id = ?", (request_id,))
+                self.__db.execute("INSERT OR REPLACE INTO url_aliases VALUES (?, ?)", (url, canonical_id))
+        record = self.get(canonical_id)
+        assert record is not None
+        return record
+
+    def mark_page(self, request_id: str, page: int, explanation: Optional[bool] = None, audio: Optional[bool] = None):
+        """pageの解説・音声の有無を記録する。Noneの項目は変更しない。"""
+        with self.__lock, self.__db:
+            self.__db.execute("INSERT OR IGNORE INTO pages (request_id, page) VALUES (?, ?)", (request_id, page))
+            if explanation is not None:
+                self.__db.execute(
+                    "UPDATE pages SET has_explanation = ? WHERE request_id = ? AND page = ?",
+                    (int(explanation), request_id, page),
+                )
+            if audio is not None:
+                self.__db.execute(
+                    "UPDATE pages SET has_audio = ? WHERE request_id = ? AND page = ?", (int(audio), request_id, page)
+                )
+
+    def has_audio(self, request_id: str, page: int) -> bool:
+        with self.__lock:
+            row = self.__db.execute(
+                "SELECT has_audio FROM pages WHERE request_id = ? AND page = ?", (request_id, page)
+            ).fetchone()
+        return row is not None and bool(row["has_audio"])
@@ -0,0 +1,54 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase, main
+
+from utils.document_index import DocumentIndex
+
+
+class DocumentIndexTest(TestCase):
+    def setUp(self):
+        self.__tmp = tempfile.TemporaryDirectory()
+        self.index = DocumentIndex(Path(self.__tmp.name) / "documents.sqlite3")
+
+    def tearDown(self):
+        self.__tmp.cleanup()
+
+    def test_get_or_create(self):
+        doc = self.index.get_or_create("https://example.com/a.pdf")
+        self.assertEqual(self.index.get_or_create("https://example.com/a.pdf").request_id, doc.request_id)
+        self.assertEqual(self.index.get_or_create("https://example.com/b.pdf", "b").request_id, "b")
+
+    def test_get_or_create_falls_back_to_aliases(self):
+        # 正規化する前のURLで登録された文書は、正規化したURLでも同じ文書になる
+        self.index.get_or_create("https://arxiv.org/abs/2401.00001", "old-id")
+        doc = self.index.get_or_create("https://arxiv.org/pdf/2401.00001", aliases=["https://arxiv.org/abs/2401.00001"])
+        self.assertEqual(doc.request_id, "old-id")
+        self.assertEqual(self.index.get_or_create("https://arxiv.org/pdf/2401.00001").request_id, "old-id")
+
+    def test_set_content_hash_merges_same_content(self):
+        first = self.index.get_or_create("https://example.com/a.pdf", "a")
+        self.index.set_content_hash(first.request_id, "hash")
+        self.index.set_page_count("a", 10, 144)
+        self.index.mark_page("a", 1, explanation=True)
+
+        second = self.index.get_or_create("https://mirror.example.com/a.pdf", "b")
+        self.index.mark_page("b", 2, audio=True)
+        doc = self.index.set_content_hash(second.request_id, "hash")
+        # 後から登録した文書は消え、そのURLは既存の文書の別名になる
+        self.assertEqual(doc.request_id, "a")
+        self.assertEqual((doc.page_count, doc.explained_pages, doc.audio_pages), (10, [1], []))
+        self.assertIsNone(self.index.get("b"))
+        self.assertEqual(self.index.get_or_create("https://mirror.example.com/a.pdf").request_id, "a")
+
+    def test_set_content_hash_keeps_different_content(self):
+        self.index.get_or_create("https://example.com/a.pdf", "a")
+        self.index.get_or_create("https://example.com/b.pdf", "b")
+        self.assertEqual(self.index.set_content_hash("a", "hash-a").request_id, "a")
+        doc = self.index.set_content_hash("b", "hash-b")
+        self.assertEqual((doc.request_id, doc.content_hash), ("b", "hash-b"))
+        # 同じ文書に同じハッシュを記録し直してもまとめない
+        self.assertEqual(self.index.set_content_hash("a", "hash-a").request_id, "a")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,103 @@
 from PIL import Image
 from io import BytesIO
+from pathlib import Path
+from typing import AsyncIterator, Optional
 import base64
 
+from utils.llm_cache import LLMCache, llm_cache_key
+from utils.rate_limit import RateLimiter, estimate_tokens, openai_rate_limiter
 
-def to_image_content(image: Image, image_type: str):
-    with BytesIO() as f_out:
-        image.save(f_out, format=image_type)
-        encoded = base64.b64encode(f_out.getvalue()).decode("utf-8")
+# 画像1枚のトークン数の見積もり(detail=highで512pxのタイル4枚分)
+IMAGE_TOKENS = 765
+
+
+def _to_image_content(data: bytes, image_type: str):
+    encoded = base64.b64encode(data).decode("utf-8")
     return {
         "type": "image_url",
         "image_url": {"url": f"data:image/{image_type};base64,{encoded}"},
     }
 
 
-def run_gpt_4o(client, messages, model="gpt-4o", json_mode=False, **kwargs):
+def to_image_content(image: Image, image_type: str):
+    with BytesIO() as f_out:
+        image.save(f_out, format=image_type)
+        return _to_image_content(f_out.getvalue(), image_type)
+
+
+def file_to_image_content(path: Path, image_type: str):
+    """保存済みの画像ファイルをデコードせずにそのまま送る。"""
+    return _to_image_content(Path(path).read_bytes(), image_type)
+
+
+def _set_json_mode(json_mode: bool, kwargs: dict):
     if json_mode:
         json_object = {"type": "json_object"}
         assert kwargs.get("response_format", json_object) == json_object
         kwargs["response_format"] = json_object
 
-    return client.chat.completions.create(model=model, messages=messages, **kwargs).choices[0].message.content
+
+def estimate_message_tokens(messages, max_tokens: Optional[int] = None) -> int:
+    """レート制限用に、messagesの入力と出力の上限を合わせたトークン数を見積もる"""
+    total = max_tokens or 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            total += estimate_tokens(content)
+            continue
+        for part in content:
+            if part["type"] == "text":
+                total += estimate_tokens(part["text"])
+            elif part["type"] == "image_url":
+                total += IMAGE_TOKENS
+    return total
+
+
+def run_gpt_4o(
+    client,
+    messages,
+    model="gpt-4o",
+    json_mode=False,
+    rate_limiter: Optional[RateLimiter] = None,
+    cache: Optional[LLMCache] = None,
+    **kwargs,
+):
+    """rate_limiterを省略するとプロセス全体で共有するopenai_rate_limiter()を使う。
+
+    cacheを渡すと、model・messages・その他の引数が同じ呼び出しには保存済みの応答を返す。
+    """
+    _set_json_mode(json_mode, kwargs)
+    key = "" if cache is None else llm_cache_key(model, messages, params=kwargs)
+    cached = None if cache is None else cache.get(key)
+    if cached is not None:
+        return cached
+    rate_limiter = rate_limiter or openai_rate_limiter()
+    completion = rate_limiter.call(
+        estimate_message_tokens(messages, kwargs.get("max_tokens")),
+        client.chat.completions.create,
+        model=model,
+        messages=messages,
+        **kwargs,
+    )
+    content = completion.choices[0].message.content
+    if cache is not None and content is not None:
+        cache.put(key, content)
+    return content
+
+
+async def stream_gpt_4o_async(
+    client, messages, model="gpt-4o", rate_limiter: Optional[RateLimiter] = None, **kwargs
+) -> AsyncIterator[str]:
+    """run_gpt_4oのopenai.AsyncClientでのストリーミング版。生成された文字列を届いた順に返す"""
+    rate_limiter = rate_limiter or openai_rate_limiter()
+    stream = await rate_limiter.call_async(
+        estimate_message_tokens(messages, kwargs.get("max_tokens")),
+        client.chat.completions.create,
+        model=model,
+        messages=messages,
+        stream=True,
+        **kwargs,
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
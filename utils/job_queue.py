@@ -0,0 +1,146 @@
+import asyncio
+import json
+import sqlite3
+import traceback
+from enum import Enum
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Optional
+from uuid import uuid4
+
+from pydantic import BaseModel
+
+from utils.time_utils import jst_now, time_json_representation
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class Job(BaseModel):
+    job_id: str
+    kind: str
+    key: str
+    payload: dict[str, Any]
+    status: JobStatus
+    error: Optional[str] = None
+    created_at: str
+    updated_at: str
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_key_status ON jobs (key, status);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+"""
+
+
+class JobQueue:
+    """SQLiteに保存する永続ジョブキュー。
+
+    ジョブはkindごとに登録したハンドラーへpayloadをキーワード引数として渡して実行する。
+    同じkeyのジョブが待ち・実行中なら新しく積まずにそれを返す。
+    start時に、前回の実行で終わらなかったジョブ(queued/running)を積み直す。
+    イベントループのスレッドからのみ使うこと。
+    """
+
+    def __init__(self, db_path: Path, max_concurrency: int = 1):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.__db = sqlite3.connect(db_path, check_same_thread=False)
+        self.__db.row_factory = sqlite3.Row
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.executescript(_SCHEMA)
+        self.__max_concurrency = max_concurrency
+        self.__handlers: dict[str, Callable[..., Awaitable[Any]]] = {}
+        self.__queue: Optional[asyncio.Queue] = None
+        self.__workers: list[asyncio.Task] = []
+
+    def register(self, kind: str, handler: Callable[..., Awaitable[Any]]):
+        self.__handlers[kind] = handler
+
+    def enqueue(self, kind: str, key: str, payload: dict[str, Any]) -> Job:
+        assert kind in self.__handlers, f"unknown job kind: {kind}"
+        row = self.__db.execute(
+            "SELECT * FROM jobs WHERE key = ? AND status IN (?, ?)",
+            (key, JobStatus.QUEUED.value, JobStatus.RUNNING.value),
+        ).fetchone()
+        if row is not None:
+            return self._to_job(row)
+
+        now = time_json_representation(jst_now())
+        job = Job(
+            job_id=str(uuid4()),
+            kind=kind,
+            key=key,
+            payload=payload,
+            status=JobStatus.QUEUED,
+            created_at=now,
+            updated_at=now,
+        )
+        with self.__db:
+            self.__db.execute(
+                "INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job.job_id, kind, key, json.dumps(payload, ensure_ascii=False), job.status.value, None, now, now),
+            )
+        if self.__queue is not None:
+            self.__queue.put_nowait(job.job_id)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        row = self.__db.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return None if row is None else self._to_job(row)
+
+    def _to_job(self, row: sqlite3.Row) -> Job:
+        return Job(**{**dict(row), "payload": json.loads(row["payload"])})
+
+    def _set_status(self, job_id: str, status: JobStatus, error: Optional[str] = None):
+        with self.__db:
+            self.__db.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE job_id = ?",
+                (status.value, error, time_json_representation(jst_now()), job_id),
+            )
+
+    async def start(self):
+        self.__queue = asyncio.Queue()
+        with self.__db:
+            self.__db.execute(
+                "UPDATE jobs SET status = ? WHERE status = ?", (JobStatus.QUEUED.value, JobStatus.RUNNING.value)
+            )
+        for row in self.__db.execute(
+            "SELECT job_id FROM jobs WHERE status = ? ORDER BY created_at", (JobStatus.QUEUED.value,)
+        ):
+            self.__queue.put_nowait(row["job_id"])
+        self.__workers = [asyncio.create_task(self._work()) for _ in range(self.__max_concurrency)]
+
+    async def stop(self):
+        for worker in self.__workers:
+            worker.cancel()
+        await asyncio.gather(*self.__workers, return_exceptions=True)
+        self.__workers = []
+        self.__queue = None
+
+    async def _work(self):
+        assert self.__queue is not None
+        while True:
+            job = self.get(await self.__queue.get())
+            if job is None or job.status != JobStatus.QUEUED:
+                continue
+            self._set_status(job.job_id, JobStatus.RUNNING)
+            try:
+                await self.__handlers[job.kind](**job.payload)
+            except Exception as e:
+                traceback.print_exc()
+                self._set_status(job.job_id, JobStatus.FAILED, error=repr(e))
+            else:
+                self._set_status(job.job_id, JobStatus.DONE)
@@ -0,0 +1,98 @@
+import asyncio
+import tempfile
+from pathlib import Path
+from unittest import TestCase, main
+
+from utils.job_queue import JobQueue, JobStatus
+
+
+async def wait_status(queue: JobQueue, job_id: str, status: JobStatus):
+    for _ in range(100):
+        job = queue.get(job_id)
+        if job is not None and job.status == status:
+            return
+        await asyncio.sleep(0.01)
+    raise TimeoutError(f"job {job_id} is not {status.value}")
+
+
+class JobQueueTest(TestCase):
+    def setUp(self):
+        self.__tmp = tempfile.TemporaryDirectory()
+        self.db_path = Path(self.__tmp.name) / "jobs.sqlite3"
+
+    def tearDown(self):
+        self.__tmp.cleanup()
+
+    def test_same_key_is_not_queued_twice(self):
+        calls = []
+
+        async def handler(page: int):
+            calls.append(page)
+
+        async def run():
+            queue = JobQueue(self.db_path)
+            queue.register("audio", handler)
+            first = queue.enqueue("audio", "audio:1", {"page": 1})
+            self.assertEqual(queue.enqueue("audio", "audio:1", {"page": 1}).job_id, first.job_id)
+            await queue.start()
+            await wait_status(queue, first.job_id, JobStatus.DONE)
+            # 終わったジョブとは別に積む
+            second = queue.enqueue("audio", "audio:1", {"page": 1})
+            self.assertNotEqual(second.job_id, first.job_id)
+            await wait_status(queue, second.job_id, JobStatus.DONE)
+            await queue.stop()
+
+        asyncio.run(run())
+        self.assertEqual(calls, [1, 1])
+
+    def test_unfinished_jobs_are_resumed_at_start(self):
+        calls = []
+
+        async def hang(page: int):
+            await asyncio.Event().wait()
+
+        async def handler(page: int):
+            calls.append(page)
+
+        async def crash() -> tuple[str, str]:
+            # 実行中のジョブと待っているジョブを残したまま止める
+            queue = JobQueue(self.db_path)
+            queue.register("audio", hang)
+            running = queue.enqueue("audio", "audio:1", {"page": 1})
+            await queue.start()
+            await wait_status(queue, running.job_id, JobStatus.RUNNING)
+            queued = queue.enqueue("audio", "audio:2", {"page": 2})
+            await queue.stop()
+            return running.job_id, queued.job_id
+
+        async def restart(job_ids: tuple[str, str]):
+            queue = JobQueue(self.db_path)
+            queue.register("audio", handler)
+            await queue.start()
+            for job_id in job_ids:
+                await wait_status(queue, job_id, JobStatus.DONE)
+            await queue.stop()
+
+        job_ids = asyncio.run(crash())
+        self.assertEqual(JobQueue(self.db_path).get(job_ids[0]).status, JobStatus.RUNNING)
+        asyncio.run(restart(job_ids))
+        self.assertEqual(calls, [1, 2])
+
+    def test_failed_job(self):
+        async def handler(page: int):
+            raise RuntimeError("failed")
+
+        async def run():
+            queue = JobQueue(self.db_path)
+            queue.register("audio", handler)
+            await queue.start()
+            job = queue.enqueue("audio", "audio:1", {"page": 1})
+            await wait_status(queue, job.job_id, JobStatus.FAILED)
+            await queue.stop()
+            return queue.get(job.job_id)
+
+        self.assertIn("RuntimeError", asyncio.run(run()).error)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+from utils.cache_utils import EVICT_TO_RATIO
+
+DEFAULT_LLM_CACHE_PATH = Path("_cache/llm/responses.db")
+DEFAULT_LLM_CACHE_BYTES = 512 * 1024**2
+DEFAULT_LLM_CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+"""
+
+
+def llm_cache_key(model: str, prompt: Any, template_hash: str = "", params: Optional[dict[str, Any]] = None) -> str:
+    """LLMの応答を決めるもの(モデル・送ったプロンプト・テンプレート・パラメータ)から作るキー。promptはJSONにできる値"""
+    key = [model, prompt, template_hash, params or {}]
+    return hashlib.sha256(json.dumps(key, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """LLMの応答の文字列をSQLiteに保存するキャッシュ。
+
+    ttl_seconds(Noneなら無期限)より古い応答は使わない。
+    合計サイズがmax_bytesを超えたら、最終アクセスが古いものからmax_bytesのEVICT_TO_RATIOまで削除する。
+    refresh=Trueなら保存済みの応答を使わずに呼び直し、結果で上書きする。
+    複数スレッドから使ってよい。
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        max_bytes: int = DEFAULT_LLM_CACHE_BYTES,
+        ttl_seconds: Optional[float] = DEFAULT_LLM_CACHE_TTL_SECONDS,
+        refresh: bool = False,
+    ):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.__db = sqlite3.connect(db_path, check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.executescript(_SCHEMA)
+        self.__lock = threading.Lock()
+        self.__max_bytes = max_bytes
+        self.__ttl_seconds = ttl_seconds
+        self.__refresh = refresh
+        self.__total_bytes: Optional[int] = None
+
+    def get(self, key: str) -> Optional[str]:
+        if self.__refresh:
+            return None
+        now = time.time()
+        with self.__lock, self.__db:
+            row = self.__db.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if self.__ttl_seconds is not None and created_at < now - self.__ttl_seconds:
+                return None
+            self.__db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        return value
+
+    def put(self, key: str, value: str):
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self.__lock, self.__db:
+            row = self.__db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.__db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", (key, value, size, now, now))
+            if self.__total_bytes is None:
+                (self.__total_bytes,) = self.__db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+            else:
+                self.__total_bytes += size - (0 if row is None else row[0])
+            if self.__total_bytes > self.__max_bytes:
+                self._evict(now)
+
+    def delete(self, key: str):
+        """使えなかった(パースできなかった)応答を消して、次は呼び直すようにする"""
+        with self.__lock, self.__db:
+            self.__db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.__total_bytes = None
+
+    def _evict(self, now: float):
+        if self.__ttl_seconds is not None:
+            self.__db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.__ttl_seconds,))
+        # 新しくアクセスされた順にサイズを足していき、max_bytes * EVICT_TO_RATIOを超えた分を消す
+        self.__db.execute(
+            """DELETE FROM responses WHERE key IN (
+                SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC, key) AS total FROM responses)
+                WHERE total > ?
+            )""",
+            (self.__max_bytes * EVICT_TO_RATIO,),
+        )
+        (self.__total_bytes,) = self.__db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+
+
+def create_llm_cache(path: Path = DEFAULT_LLM_CACHE_PATH, refresh: bool = False) -> LLMCache:
+    return LLMCache(path, refresh=refresh)
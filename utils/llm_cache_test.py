@@ -0,0 +1,57 @@
+import tempfile
+import time
+from pathlib import Path
+from unittest import TestCase, main
+
+from utils.llm_cache import LLMCache, llm_cache_key
+
+
+class LLMCacheTest(TestCase):
+    def setUp(self):
+        self.__tmp = tempfile.TemporaryDirectory()
+        self.db_path = Path(self.__tmp.name) / "llm.db"
+
+    def tearDown(self):
+        self.__tmp.cleanup()
+
+    def test_key(self):
+        self.assertEqual(llm_cache_key("m", "p", "t", {"a": 1, "b": 2}), llm_cache_key("m", "p", "t", {"b": 2, "a": 1}))
+        self.assertNotEqual(llm_cache_key("m", "p", "t"), llm_cache_key("m", "p", "u"))
+        self.assertNotEqual(llm_cache_key("m", "p"), llm_cache_key("n", "p"))
+
+    def test_get_put(self):
+        cache = LLMCache(self.db_path)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", "応答")
+        self.assertEqual(cache.get("a"), "応答")
+        self.assertEqual(LLMCache(self.db_path).get("a"), "応答")
+        self.assertIsNone(LLMCache(self.db_path, refresh=True).get("a"))
+
+    def test_ttl(self):
+        cache = LLMCache(self.db_path, ttl_seconds=0.05)
+        cache.put("a", "x")
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("a"))
+
+    def test_evicts_least_recently_used(self):
+        cache = LLMCache(self.db_path, max_bytes=10)
+        cache.put("a", "1234")
+        cache.put("b", "1234")
+        cache.get("a")
+        cache.put("c", "1234")
+        self.assertEqual(cache.get("a"), "1234")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "1234")
+
+    def test_evicts_below_max_bytes(self):
+        # 上限を超えたら上限の9割まで消すので、続くputでは削除が起きない
+        cache = LLMCache(self.db_path, max_bytes=100)
+        for i in range(11):
+            cache.put(f"k{i:02d}", "0123456789")
+        self.assertEqual([cache.get(f"k{i:02d}") is not None for i in range(11)], [False] * 2 + [True] * 9)
+        cache.put("k11", "0123456789")
+        self.assertEqual(sum(cache.get(f"k{i:02d}") is not None for i in range(12)), 10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import hashlib
+import os
+import sys
+from pathlib import Path
+from urllib.parse import urlparse
+
+import httpx
+
+from utils.arxiv_utils import to_arxiv_id
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+ARXIV_HOSTS = {"arxiv.org", "www.arxiv.org", "export.arxiv.org"}
+
+
+def normalize_pdf_url(url: str) -> str:
+    """arXivの /abs/・/pdf/(.pdf付きも)のURLを https://arxiv.org/pdf/<id> にそろえる。
+
+    それ以外(IDを含まないarXivのURLも)はそのまま返す。
+    """
+    parsed = urlparse(url)
+    if parsed.hostname in ARXIV_HOSTS and parsed.path.startswith(("/abs/", "/pdf/")):
+        arxiv_id = to_arxiv_id(url)
+        if arxiv_id:
+            return f"https://arxiv.org/pdf/{arxiv_id}"
+    return url
+
+
+def file_sha256(path: Path, chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f_in:
+        while chunk := f_in.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download_pdf(
+    url: str,
+    output_path: Path,
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+    timeout: float = 60.0,
+    max_attempts: int = 3,
+) -> str:
+    """urlのPDFをoutput_pathへチャンクごとに書き出し、内容のsha256を返す。
+
+    書き込み中は .part に保存し、接続が切れたらRangeリクエストで続きから再開する。
+    output_pathが既にあればダウンロードしない。
+    """
+    if output_path.exists():
+        return file_sha256(output_path)
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    part_path = output_path.with_name(output_path.name + ".part")
+    for attempt in range(1, max_attempts + 1):
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with httpx.stream("GET", url, headers=headers, follow_redirects=True, timeout=timeout) as response:
+                if offset and response.status_code == 416:
+                    # 前回の .part で全部受け取っていた
+                    break
+                response.raise_for_status()
+                # Rangeに対応していないサーバーは全体を返すので最初から書き直す
+                mode = "ab" if offset and response.status_code == 206 else "wb"
+                with open(part_path, mode) as f_out:
+                    for chunk in response.iter_bytes(chunk_size):
+                        f_out.write(chunk)
+            break
+        except httpx.TransportError as e:
+            if attempt == max_attempts:
+                raise
+            print(f"[WARN] Download interrupted ({e!r}), resuming {url} ({attempt}/{max_attempts})", file=sys.stderr)
+
+    content_hash = file_sha256(part_path, chunk_size)
+    os.replace(part_path, output_path)
+    return content_hash
@@ -0,0 +1,39 @@
+from unittest import TestCase, main
+
+from utils.arxiv_utils import to_arxiv_id
+from utils.pdf_download import normalize_pdf_url
+
+
+class NormalizePdfUrlTest(TestCase):
+    def test_arxiv_urls(self):
+        for url in [
+            "https://arxiv.org/abs/2401.00001",
+            "https://arxiv.org/pdf/2401.00001",
+            "https://arxiv.org/pdf/2401.00001.pdf",
+            "http://www.arxiv.org/abs/2401.00001/",
+            "https://export.arxiv.org/abs/2401.00001",
+        ]:
+            self.assertEqual(normalize_pdf_url(url), "https://arxiv.org/pdf/2401.00001", url)
+        self.assertEqual(normalize_pdf_url("https://arxiv.org/abs/2401.00001v2"), "https://arxiv.org/pdf/2401.00001v2")
+        self.assertEqual(
+            normalize_pdf_url("https://arxiv.org/abs/hep-th/9901001"), "https://arxiv.org/pdf/hep-th/9901001"
+        )
+
+    def test_other_urls_are_unchanged(self):
+        for url in [
+            "https://example.com/abs/2401.00001.pdf",
+            "https://arxiv.org/",
+            "https://arxiv.org/pdf/",
+            "https://arxiv.org/list/cs.CV/recent",
+        ]:
+            self.assertEqual(normalize_pdf_url(url), url)
+
+    def test_to_arxiv_id(self):
+        self.assertEqual(to_arxiv_id("https://arxiv.org/abs/2401.00001"), "2401.00001")
+        self.assertEqual(to_arxiv_id("https://arxiv.org/pdf/2401.00001.pdf"), "2401.00001")
+        self.assertEqual(to_arxiv_id("https://arxiv.org/pdf/hep-th/9901001"), "hep-th/9901001")
+        self.assertEqual(to_arxiv_id("2401.00001"), "2401.00001")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,15 +4,16 @@ import boto3
 from enum import Enum
 from PIL import Image
 import numpy as np
-from typing import Optional
+from typing import Iterable, Optional
 import subprocess
 import tempfile
 from dataclasses import dataclass
 import json
-from pdf2image import convert_from_path
 
 from pathlib import Path
 
+from utils.pdf_pages import PDFPageSource
+
 
 class BlockType(Enum):
     KEY_VALUE_SET = "KEY_VALUE_SET", False, False, False
@@ -175,8 +176,7 @@ def extract_pdf_by_textract(
     else:
         results = json.loads(output_textract_result.read_text())
 
-    pdf_images = convert_from_path(pdf_path)
-    pdf_parts = gather_pdf_parts(results, pdf_images)
+    pdf_parts = gather_pdf_parts(results, PDFPageSource(pdf_path))
     output_jsonl = output_dir / "pdf_parts.jsonl"
 
     with output_jsonl.open("w") as output_json:
@@ -185,7 +185,7 @@ def extract_pdf_by_textract(
             print(json.dumps(d, ensure_ascii=False), file=output_json)
 
 
-def gather_pdf_parts(results, pdf_images: list[Image]) -> list[PDFPart]:
+def gather_pdf_parts(results, pdf_images: Iterable[Image]) -> list[PDFPart]:
     pdf_parts = []
     part_index = 0
     image_index = 0
@@ -288,31 +288,33 @@ def extract_pdf_data_to_md(extracted_dir: Path):
 
 
 def plot_pdf_parts(pdf_path: Path, extracted_dir: Path):
-    pdf_images = [np.array(image)[..., ::-1].copy() for image in convert_from_path(pdf_path)]
     pdf_parts = [json.loads(line) for line in (extracted_dir / "pdf_parts.jsonl").read_text().splitlines()]
+    page_to_parts = defaultdict(list)
     for part in pdf_parts:
-        page = part["page"] - 1
-        pdf_image = pdf_images[page]
-        height, width = pdf_image.shape[:2]
-        xmin = int(part["layout"]["xmin"] * width)
-        ymin = int(part["layout"]["ymin"] * height)
-        xmax = int(part["layout"]["xmax"] * width)
-        ymax = int(part["layout"]["ymax"] * height)
-        cv2.rectangle(pdf_image, (xmin, ymin), (xmax, ymax), (0, 255, 0), 2)
-        message = f"[{part['part_index']}]"
-        cv2.putText(
-            pdf_image,
-            message,
-            (xmin, ymin),
-            cv2.FONT_HERSHEY_SIMPLEX,
-            1,
-            (0, 255, 0),
-            2,
-            cv2.LINE_AA,
-        )
+        page_to_parts[part["page"]].append(part)
+
     output_dir = extracted_dir / "pdf_parts_images"
     output_dir.mkdir(exist_ok=True, parents=True)
-    for i, pdf_image in enumerate(pdf_images, start=1):
+    for i, image in enumerate(PDFPageSource(pdf_path), start=1):
+        pdf_image = np.array(image)[..., ::-1].copy()
+        height, width = pdf_image.shape[:2]
+        for part in page_to_parts[i]:
+            xmin = int(part["layout"]["xmin"] * width)
+            ymin = int(part["layout"]["ymin"] * height)
+            xmax = int(part["layout"]["xmax"] * width)
+            ymax = int(part["layout"]["ymax"] * height)
+            cv2.rectangle(pdf_image, (xmin, ymin), (xmax, ymax), (0, 255, 0), 2)
+            message = f"[{part['part_index']}]"
+            cv2.putText(
+                pdf_image,
+                message,
+                (xmin, ymin),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                1,
+                (0, 255, 0),
+                2,
+                cv2.LINE_AA,
+            )
         output_path = output_dir / f"{i:06d}.jpg"
         cv2.imwrite(str(output_path), pdf_image[..., ::-1])
 
@@ -0,0 +1,112 @@
+import os
+import tempfile
+import threading
+from functools import cached_property
+from pathlib import Path
+from typing import Iterator, Optional
+
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL import Image
+
+DEFAULT_DPI = 200
+PAGE_IMAGE_FORMAT = "{page:04d}.png"
+
+
+def render_page_file(pdf_path: Path, page: int, output_path: Path, dpi: int = DEFAULT_DPI):
+    """pageページ目をpdftoppmに直接PNGで書き出させる。Python側で画像をデコード・エンコードしない。"""
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=output_path.parent, prefix=".render_") as tmpdir:
+        (path,) = convert_from_path(
+            pdf_path,
+            dpi=dpi,
+            first_page=page,
+            last_page=page,
+            output_folder=tmpdir,
+            fmt="png",
+            single_file=True,
+            output_file="page",
+            paths_only=True,
+        )
+        os.replace(path, output_path)
+
+
+class PDFPageSource:
+    """PDFのページ画像を必要になった時点で1ページずつ描画する。
+
+    cache_dirを指定すると描画結果をPAGE_IMAGE_FORMATの名前で保存し、次回からはそれを読む。
+    同じインスタンスを複数スレッドから使っても、同じページを二重に描画することはない。
+    page_countが分かっていれば渡しておくと、PDFのメタデータを読まずに済む。
+    """
+
+    def __init__(
+        self,
+        pdf_path: Path,
+        dpi: int = DEFAULT_DPI,
+        cache_dir: Optional[Path] = None,
+        page_count: Optional[int] = None,
+    ):
+        self.__pdf_path = pdf_path
+        self.__dpi = dpi
+        self.__cache_dir = cache_dir
+        self.__locks: dict[int, threading.Lock] = {}
+        self.__locks_lock = threading.Lock()
+        if page_count is not None:
+            self.__dict__["page_count"] = page_count
+
+    @property
+    def dpi(self) -> int:
+        return self.__dpi
+
+    @cached_property
+    def page_count(self) -> int:
+        return int(pdfinfo_from_path(str(self.__pdf_path))["Pages"])
+
+    def __len__(self) -> int:
+        return self.page_count
+
+    def __iter__(self) -> Iterator[Image.Image]:
+        return self.iter_pages()
+
+    def page_path(self, page: int) -> Optional[Path]:
+        if self.__cache_dir is None:
+            return None
+        return self.__cache_dir / PAGE_IMAGE_FORMAT.format(page=page)
+
+    def _check_page(self, page: int):
+        if not 1 <= page <= self.page_count:
+            raise IndexError(f"page {page} is out of range (1-{self.page_count})")
+
+    def _render(self, page: int) -> Image.Image:
+        (image,) = convert_from_path(self.__pdf_path, dpi=self.__dpi, first_page=page, last_page=page)
+        return image
+
+    def _page_lock(self, page: int) -> threading.Lock:
+        with self.__locks_lock:
+            return self.__locks.setdefault(page, threading.Lock())
+
+    def ensure_rendered(self, page: int) -> Path:
+        """pageページ目をキャッシュに描画し、そのパスを返す。描画済みなら何もしない。"""
+        path = self.page_path(page)
+        if path is None:
+            raise ValueError("cache_dir is not set")
+        if path.exists():
+            return path
+
+        self._check_page(page)
+        with self._page_lock(page):
+            if not path.exists():
+                render_page_file(self.__pdf_path, page, path, self.__dpi)
+        return path
+
+    def render(self, page: int) -> Image.Image:
+        """pageページ目(1始まり)の画像を返す。"""
+        if self.__cache_dir is not None:
+            return Image.open(self.ensure_rendered(page))
+        self._check_page(page)
+        return self._render(page)
+
+    def iter_pages(self, first_page: int = 1, last_page: Optional[int] = None) -> Iterator[Image.Image]:
+        if last_page is None:
+            last_page = self.page_count
+        for page in range(first_page, last_page + 1):
+            yield self.render(page)
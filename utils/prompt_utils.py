@@ -1,16 +1,30 @@
+import asyncio
+import functools
+import hashlib
+import os
 import re
-import time
 import sys
+import threading
 from abc import ABC
 from pathlib import Path
 from dataclasses import dataclass, replace
 import json
-from typing import TypeVar, Type, Generic, Callable, Any, Optional, cast
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TypeVar, Type, Generic, Callable, Any, Optional, Awaitable, Collection, cast
 import traceback
 
 import openai
-from pydantic import BaseModel, create_model
-from jinja2 import Environment, FileSystemLoader, Template
+from pydantic import BaseModel, ValidationError, create_model
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template
+
+from utils.llm_cache import LLMCache, llm_cache_key
+from utils.rate_limit import (
+    RateLimiter,
+    async_openai_client,
+    estimate_tokens,
+    openai_client,
+    openai_rate_limiter,
+)
 
 T_IN = TypeVar("T_IN", bound=BaseModel)
 T_CONTEXT = TypeVar("T_CONTEXT", bound=BaseModel, contravariant=True)
@@ -18,8 +32,14 @@ T_OUT = TypeVar("T_OUT")
 
 
 class Adapter(Generic[T_CONTEXT, T_IN]):
-    def __init__(self, fn: Callable[[T_CONTEXT], T_IN]):
+    def __init__(self, fn: Callable[[T_CONTEXT], T_IN], reads: Optional[Collection[str]] = None):
+        """readsはfnが読む文脈のフィールド名。Noneなら全てのフィールドを読むものとして扱う"""
         self.__fn = fn
+        self.__reads = None if reads is None else frozenset(reads)
+
+    @property
+    def reads(self) -> Optional[frozenset[str]]:
+        return self.__reads
 
     def __call__(self, context: T_CONTEXT) -> T_IN:
         return self.__fn(context)
@@ -36,7 +56,7 @@ class Adapter(Generic[T_CONTEXT, T_IN]):
         def fn(x: T_CONTEXT) -> T_IN:
             return type_to(**{key: getattr(x, key) for key in type_to.model_fields})
 
-        return cls(fn)
+        return cls(fn, reads=type_to.model_fields.keys())
 
     @classmethod
     def field(cls, field_name: str, type_: Type[T_IN]) -> "Adapter[T_CONTEXT, T_IN]":
@@ -45,7 +65,7 @@ class Adapter(Generic[T_CONTEXT, T_IN]):
             assert isinstance(value, type_)
             return value
 
-        return cls(fn)
+        return cls(fn, reads=[field_name])
 
 
 def fix_json(text: str) -> str:
@@ -53,24 +73,123 @@ def fix_json(text: str) -> str:
     return re.sub(r'(\\[^"])', r"\\\1", text)
 
 
+class OutputParseError(RuntimeError):
+    """LLMの出力がoutput_typeとして読めなかった。
+
+    dataは読めたJSONのオブジェクト、fieldsは不正だったフィールド。fieldsだけを聞き直せないときはdataがNone。
+    """
+
+    def __init__(self, message: str, raw: str, data: Optional[dict[str, Any]], fields: list[str], details: str = ""):
+        super().__init__(message)
+        self.raw = raw
+        self.data = data
+        self.fields = fields
+        self.details = details
+
+
+def _is_json_error(error: ValidationError) -> bool:
+    return any(e["type"] == "json_invalid" for e in error.errors())
+
+
 def _parse(value: str, type_: Type) -> str | BaseModel:
-    if issubclass(type_, BaseModel):
-        raw = value
-        try:
-            json.loads(value)
-        except json.JSONDecodeError:
-            value = fix_json(value)
+    if not (isinstance(type_, type) and issubclass(type_, BaseModel)):
+        return value
 
+    text = value
+    try:
+        return type_.model_validate_json(text)
+    except ValidationError as e:
+        error = e
+    if _is_json_error(error):
+        # structured outputsを使わない呼び出しでは、
+        # コードブロックで囲まれたりエスケープが崩れたりしたJSONが返ることがある
+        text = fix_json(value)
         try:
-            return type_.parse_raw(value)
-        except json.JSONDecodeError:
-            raise RuntimeError(f"JSONデコードエラー\n[元データ]\n{raw}\n[修正]\n{value}")
-        except Exception:
-            raise RuntimeError(
-                f"パースエラー\n[元データ]{raw}\n\n[期待されるフィールド] {list(type_.model_fields.keys())}"
-            )
-    else:
-        return value
+            return type_.model_validate_json(text)
+        except ValidationError as e:
+            error = e
+    if _is_json_error(error):
+        raise OutputParseError(f"JSONデコードエラー\n[元データ]\n{value}\n[修正]\n{text}", value, None, [])
+
+    data = json.loads(text)
+    fields = sorted({str(e["loc"][0]) for e in error.errors() if e["loc"]})
+    repairable = isinstance(data, dict) and fields and all(field in type_.model_fields for field in fields)
+    raise OutputParseError(
+        f"パースエラー\n[元データ]{value}\n\n"
+        f"[期待されるフィールド] {list(type_.model_fields.keys())}\n[エラー]\n{error}",
+        value,
+        data if repairable else None,
+        fields,
+        str(error),
+    )
+
+
+_UNSUPPORTED_STRICT_KEYWORDS = {"oneOf", "prefixItems", "patternProperties"}
+
+
+def _to_strict_schema(schema: dict[str, Any]) -> Optional[dict[str, Any]]:
+    """structured outputsのstrictモードの制約に合わせたスキーマ。合わせられなければNone
+
+    objectは全てのプロパティを必須にし、それ以外のプロパティを禁止する(既定値のあるフィールドも毎回出力させる)。
+    """
+    if _UNSUPPORTED_STRICT_KEYWORDS & schema.keys():
+        return None
+    schema = {key: value for key, value in schema.items() if key != "default"}
+    for key in ["properties", "$defs"]:
+        if key in schema:
+            children = {name: _to_strict_schema(child) for name, child in schema[key].items()}
+            if any(child is None for child in children.values()):
+                return None
+            schema[key] = children
+    for key in ["anyOf", "allOf"]:
+        if key in schema:
+            children = [_to_strict_schema(child) for child in schema[key]]
+            if any(child is None for child in children):
+                return None
+            schema[key] = children
+    if isinstance(schema.get("items"), dict):
+        schema["items"] = _to_strict_schema(schema["items"])
+        if schema["items"] is None:
+            return None
+    if schema.get("type") == "object":
+        if "properties" not in schema:
+            # キーが決まっていないdictはstrictモードでは表せない
+            return None
+        schema["additionalProperties"] = False
+        schema["required"] = list(schema["properties"])
+    return schema
+
+
+@functools.lru_cache(maxsize=None)
+def json_schema_response_format(type_: Type[BaseModel]) -> dict[str, Any]:
+    """type_のJSONスキーマでstructured outputsを使うresponse_format。strictモードにできないスキーマはstrictなしで送る"""
+    schema = type_.model_json_schema()
+    strict_schema = _to_strict_schema(schema)
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": re.sub(r"[^a-zA-Z0-9_-]", "_", type_.__name__),
+            "schema": schema if strict_schema is None else strict_schema,
+            "strict": strict_schema is not None,
+        },
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def _repair_type(type_: Type[BaseModel], fields: tuple[str, ...]) -> Type[BaseModel]:
+    return create_model(
+        f"{type_.__name__}_repair",
+        **{field: (type_.model_fields[field].annotation, type_.model_fields[field]) for field in fields},
+    )  # type: ignore
+
+
+@dataclass(frozen=True)
+class RepairRequest:
+    """不正だったフィールドだけを聞き直すプロンプトと、その応答の型"""
+
+    prompt: str
+    output_type: Type[BaseModel]
+    fields: list[str]
 
 
 class TypedPrompt(Generic[T_IN, T_OUT]):
@@ -78,6 +197,12 @@ class TypedPrompt(Generic[T_IN, T_OUT]):
         self.__template = template
         self.__input_type = input_type
         self.__output_type = output_type
+        self.__template_hash = template_registry().source_hash(template.filename)
+
+    @property
+    def template_hash(self) -> str:
+        """テンプレートのファイルの内容のハッシュ。LLMの応答のキャッシュのキーに使う"""
+        return self.__template_hash
 
     @property
     def input_type(self) -> Type[T_IN]:
@@ -91,16 +216,147 @@ class TypedPrompt(Generic[T_IN, T_OUT]):
         assert isinstance(input_, self.__input_type)
         return self.__template.render(**input_.dict())
 
+    @property
+    def response_format(self) -> Optional[dict[str, Any]]:
+        """出力がBaseModelなら、そのJSONスキーマで出力させるstructured outputsのresponse_format"""
+        output_type = self.__output_type
+        if isinstance(output_type, type) and issubclass(output_type, BaseModel):
+            return json_schema_response_format(output_type)
+        return None
+
     def parse(self, value: str) -> T_OUT:
+        """読めなければOutputParseErrorを投げる"""
         return cast(T_OUT, _parse(value, self.__output_type))
 
+    def repair_request(self, prompt: str, error: OutputParseError) -> Optional[RepairRequest]:
+        """errorのフィールドだけを聞き直すRepairRequest。聞き直せなければNone
+
+        元のプロンプトをそのまま先頭に置くので、OpenAIのプロンプトキャッシュが効き、出力も不正だったフィールドの分だけで済む。
+        """
+        if error.data is None:
+            return None
+        output_type = cast(Type[BaseModel], self.__output_type)
+        text = f"""{prompt}
+
+[あなたの回答]
+{error.raw}
+
+[エラー]
+{error.details}
+
+上の回答のうち {", ".join(error.fields)} が不正です。これらのフィールドだけを修正し、JSONで出力してください。"""
+        return RepairRequest(text, _repair_type(output_type, tuple(error.fields)), error.fields)
+
+    def apply_repair(self, error: OutputParseError, request: RepairRequest, value: str) -> T_OUT:
+        """聞き直した応答valueで、errorの出力の不正だったフィールドを置き換える"""
+        assert error.data is not None
+        repaired = cast(BaseModel, _parse(value, request.output_type))
+        output_type = cast(Type[BaseModel], self.__output_type)
+        return cast(T_OUT, output_type.model_validate({**error.data, **repaired.model_dump()}))
+
+
+DEFAULT_TEMPLATE_BYTECODE_CACHE_DIR = Path("_cache/jinja")
+
+
+class TemplateRegistry:
+    """テンプレートのディレクトリごとにjinja2のEnvironmentを1つ作って使い回す。複数スレッドから使ってよい。
+
+    コンパイルしたテンプレートはEnvironmentが保持し、ファイルの更新時刻が変わったら読み直す(auto_reload)。
+    bytecode_cache_dirを指定すると、コンパイル結果をディスクにも保存して別のプロセスでも使う(ソースが変われば作り直す)。
+    """
+
+    def __init__(self, bytecode_cache_dir: Optional[Path] = None):
+        self.__bytecode_cache = None
+        if bytecode_cache_dir is not None:
+            bytecode_cache_dir.mkdir(parents=True, exist_ok=True)
+            self.__bytecode_cache = FileSystemBytecodeCache(str(bytecode_cache_dir))
+        self.__environments: dict[Path, Environment] = {}
+        self.__source_hashes: dict[str, tuple[int, int, str]] = {}
+        self.__lock = threading.Lock()
+
+    def environment(self, template_root: Path) -> Environment:
+        template_root = template_root.resolve()
+        with self.__lock:
+            if template_root not in self.__environments:
+                self.__environments[template_root] = Environment(
+                    loader=FileSystemLoader(template_root, encoding="utf8"),
+                    bytecode_cache=self.__bytecode_cache,
+                    auto_reload=True,
+                )
+            return self.__environments[template_root]
+
+    def get(self, template_path: Path, template_root: Optional[Path] = None) -> Template:
+        if template_root is None:
+            template_root = template_path.parent
+            template_path = Path(template_path.name)
+        return self.environment(template_root).get_template(template_path.as_posix())
+
+    def source_hash(self, filename: Optional[str]) -> str:
+        """テンプレートのファイルの内容のsha256。ファイルのない(文字列から作った)テンプレートは空の内容として扱う"""
+        try:
+            stat = os.stat(filename or "")
+        except OSError:
+            return hashlib.sha256(b"").hexdigest()
+        assert filename is not None
+        with self.__lock:
+            cached = self.__source_hashes.get(filename)
+        if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+        source_hash = hashlib.sha256(Path(filename).read_bytes()).hexdigest()
+        with self.__lock:
+            self.__source_hashes[filename] = (stat.st_mtime_ns, stat.st_size, source_hash)
+        return source_hash
+
+    def precompile(self, template_root: Path, pattern: str = "**/*.j2") -> list[str]:
+        """template_root以下のテンプレートをコンパイルしておく。コンパイルしたテンプレートの名前を返す"""
+        names = sorted(path.relative_to(template_root).as_posix() for path in template_root.glob(pattern))
+        env = self.environment(template_root)
+        for name in names:
+            env.get_template(name)
+        return names
+
+
+_template_registry: Optional[TemplateRegistry] = None
+_template_registry_lock = threading.Lock()
+
+
+def template_registry() -> TemplateRegistry:
+    """プロセス全体で共有するTemplateRegistry。環境変数JINJA_BYTECODE_CACHE_DIRがあればバイトコードをそこに保存する"""
+    global _template_registry
+    with _template_registry_lock:
+        if _template_registry is None:
+            bytecode_cache_dir = os.environ.get("JINJA_BYTECODE_CACHE_DIR")
+            _template_registry = TemplateRegistry(None if bytecode_cache_dir is None else Path(bytecode_cache_dir))
+        return _template_registry
+
 
 def load_template(template_path: Path, template_root: Optional[Path] = None) -> Template:
-    if template_root is None:
-        template_root = template_path.parent
-        template_path = Path(template_path.name)
-    env = Environment(loader=FileSystemLoader(template_root, encoding="utf8"))
-    return env.get_template(str(template_path))
+    return template_registry().get(template_path, template_root)
+
+
+_context_types: dict[tuple[Type[BaseModel], str, Type], Type[BaseModel]] = {}
+_context_types_lock = threading.Lock()
+
+
+def context_type_after(base: Type[BaseModel], name: str, output_type: Type) -> Type[BaseModel]:
+    """baseにnameの段の出力(output_type)のフィールドを足した文脈の型。同じ組み合わせには同じクラスを返す"""
+    key = (base, name, output_type)
+    with _context_types_lock:
+        if key not in _context_types:
+            _context_types[key] = create_model(
+                f"_ContextTypeAfter_{name}",
+                **{name: (output_type, None)},
+                __base__=base,
+            )  # type: ignore
+        return _context_types[key]
+
+
+def extend_context(next_type: Type[BaseModel], context: BaseModel, name: str, value: Any) -> BaseModel:
+    """contextにnameの段の出力を足したnext_typeの文脈を作る。
+
+    contextと段の出力は検証済みなので、検証もコピーもせずに組み立てる(入力の大きさ・段の数に比例するコストがかからない)。
+    """
+    return next_type.model_construct(_fields_set=context.model_fields_set | {name}, **{**dict(context), name: value})
 
 
 @dataclass
@@ -116,9 +372,60 @@ class ExecutionState:
 
 
 class Executor(ABC, Generic[T_IN]):
-    def __init__(self, fn: Callable[[str], str], max_retry: int):
+    def __init__(
+        self,
+        fn: Callable[..., str],
+        max_retry: int,
+        async_fn: Optional[Callable[..., Awaitable[str]]] = None,
+        cache: Optional[LLMCache] = None,
+        model: str = "",
+        structured_output: bool = False,
+    ):
+        """async_fnはTactic.run_asyncで使う。省略時はfnを別スレッドで呼ぶ。
+
+        cacheを渡すと、fnの結果を(model, プロンプト, テンプレート)ごとに保存して使い回す。modelはfnが使うモデル名。
+        structured_output=Trueなら、出力がBaseModelの段ではfn(prompt, response_format=...)のようにJSONスキーマを渡す
+        (call_gptなどOpenAIのstructured outputsを使える関数のとき)。
+        出力の一部のフィールドだけが不正なら、全体を呼び直す前にそのフィールドだけを聞き直す。
+        """
         self.__fn = fn
         self.__max_retry = max_retry
+        self.__async_fn = async_fn
+        self.__cache = cache
+        self.__model = model
+        self.__structured_output = structured_output
+
+    def _call_kwargs(self, output_type: Type) -> dict[str, Any]:
+        if not (self.__structured_output and isinstance(output_type, type) and issubclass(output_type, BaseModel)):
+            return {}
+        return {"response_format": json_schema_response_format(output_type)}
+
+    def _lookup(self, typed_prompt: TypedPrompt, prompt: str) -> tuple[Optional[str], Optional[str]]:
+        """キャッシュのキーと、保存済みの応答(なければNone)を返す。キャッシュを使わないならキーもNone"""
+        if self.__cache is None:
+            return None, None
+        key = llm_cache_key(
+            self.__model, prompt, typed_prompt.template_hash, self._call_kwargs(typed_prompt.output_type)
+        )
+        return key, self.__cache.get(key)
+
+    def _invalidate(self, key: Optional[str], cached: bool):
+        # 保存済みの応答がパースできなければ消して、次は呼び直す
+        if cached and self.__cache is not None and key is not None:
+            self.__cache.delete(key)
+
+    def _store(self, key: Optional[str], output: str):
+        # パースできた応答だけを保存する
+        if self.__cache is not None and key is not None:
+            self.__cache.put(key, output)
+
+    def _repair_request(
+        self, name: str, typed_prompt: TypedPrompt, prompt: str, error: OutputParseError
+    ) -> Optional[RepairRequest]:
+        request = typed_prompt.repair_request(prompt, error)
+        if request is not None:
+            print(f"[WARN] {name}: re-asking only for {', '.join(request.fields)}", file=sys.stderr)
+        return request
 
     def build_function(
         self,
@@ -152,38 +459,168 @@ class Executor(ABC, Generic[T_IN]):
         def fn(context: BaseModel) -> Any:
             input_ = adapter(context)
             assert isinstance(input_, typed_prompt.input_type)
-            result = typed_prompt.parse(self.__fn(typed_prompt.generate_input(input_)))
-            next_context = next_type(**{name: result}, **context.dict())
+            prompt = typed_prompt.generate_input(input_)
+            key, output = self._lookup(typed_prompt, prompt)
+            cached = output is not None
+            if output is None:
+                output = self.__fn(prompt, **self._call_kwargs(typed_prompt.output_type))
+            try:
+                result = typed_prompt.parse(output)
+            except OutputParseError as e:
+                self._invalidate(key, cached)
+                request = self._repair_request(name, typed_prompt, prompt, e)
+                if request is None:
+                    raise
+                repaired = self.__fn(request.prompt, **self._call_kwargs(request.output_type))
+                result = typed_prompt.apply_repair(e, request, repaired)
+                output, cached = result.model_dump_json(), False
+            if not cached:
+                self._store(key, output)
+            next_context = extend_context(next_type, context, name, result)
             return result, next_context
 
         return fn
 
+    async def _call_async(self, prompt: str, output_type: Type) -> str:
+        kwargs = self._call_kwargs(output_type)
+        if self.__async_fn is not None:
+            return await self.__async_fn(prompt, **kwargs)
+        return await asyncio.to_thread(self.__fn, prompt, **kwargs)
+
+    def build_async_function(
+        self,
+        name: str,
+        adapter: Adapter,
+        typed_prompt: TypedPrompt,
+        next_type: Type[BaseModel],
+    ) -> Callable[[ExecutionState], Awaitable[tuple[Any, ExecutionState]]]:
+        return self._wrap_async_base_function(self._build_async_base_function(name, adapter, typed_prompt, next_type))
+
+    def _wrap_async_base_function(self, base_function: Callable[[BaseModel], Awaitable[tuple[Any, BaseModel]]]):
+        async def fn(state: ExecutionState) -> tuple[Any, ExecutionState]:
+            for _ in range(state.error_count, self.__max_retry):
+                try:
+                    result, next_context = await base_function(state.context)
+                    return result, state.update_context(next_context)
+                except Exception:
+                    traceback.print_exc()
+                    state = state.add_error()
+            raise Exception("Too many errors")
+
+        return fn
+
+    def _build_async_base_function(
+        self,
+        name: str,
+        adapter: Adapter,
+        typed_prompt: TypedPrompt,
+        next_type: Type[BaseModel],
+    ) -> Callable[[BaseModel], Awaitable[Any]]:
+        async def fn(context: BaseModel) -> Any:
+            input_ = adapter(context)
+            assert isinstance(input_, typed_prompt.input_type)
+            prompt = typed_prompt.generate_input(input_)
+            key, output = self._lookup(typed_prompt, prompt)
+            cached = output is not None
+            if output is None:
+                output = await self._call_async(prompt, typed_prompt.output_type)
+            try:
+                result = typed_prompt.parse(output)
+            except OutputParseError as e:
+                self._invalidate(key, cached)
+                request = self._repair_request(name, typed_prompt, prompt, e)
+                if request is None:
+                    raise
+                repaired = await self._call_async(request.prompt, request.output_type)
+                result = typed_prompt.apply_repair(e, request, repaired)
+                output, cached = result.model_dump_json(), False
+            if not cached:
+                self._store(key, output)
+            next_context = extend_context(next_type, context, name, result)
+            return result, next_context
+
+        return fn
+
+
+@dataclass(frozen=True)
+class TacticStep:
+    name: str
+    context_type: Type[BaseModel]  # この段に渡す文脈の型(前の段までの出力を持つ)
+    function: Callable[[ExecutionState], tuple[Any, ExecutionState]]
+    async_function: Callable[[ExecutionState], Awaitable[tuple[Any, ExecutionState]]]
+    depends_on: frozenset[int]  # 間接的なものも含めた、依存する段の番号
+
+
+# 段の出力・段に渡した状態・段が返した状態
+_StepOutput = tuple[Any, ExecutionState, ExecutionState]
+
 
 class Tactic:
+    """TacticBuilderで組み立てた段を実行する。依存関係のない段は同時に実行する。"""
+
     def __init__(
         self,
         input_type: Type[BaseModel],
-        output_type: Type[BaseModel] | Type[str],
-        functions: list[Callable[[ExecutionState], tuple[Any, ExecutionState]]],
+        output_type: Type[BaseModel],
+        steps: list[TacticStep],
     ):
         self.__input_type = input_type
         self.__output_type = output_type
-        self.__functions = functions
+        self.__steps = steps
 
     @property
     def input_type(self) -> Type[BaseModel]:
         return self.__input_type
 
     @property
-    def output_type(self) -> Type[BaseModel] | Type[str]:
+    def output_type(self) -> Type[BaseModel]:
         return self.__output_type
 
+    def _step_state(self, step: TacticStep, context: BaseModel, outputs: dict[int, _StepOutput]) -> ExecutionState:
+        # 依存する段の出力だけを入れた文脈を作る。どの段が先に終わっても同じ入力になる
+        values = {self.__steps[i].name: outputs[i][0] for i in step.depends_on}
+        error_count = max((outputs[i][2].error_count for i in step.depends_on), default=0)
+        return ExecutionState(step.context_type.model_construct(**dict(context), **values), error_count)
+
+    def _merge(self, context: BaseModel, outputs: list[_StepOutput]) -> tuple[Any, ExecutionState]:
+        values = {step.name: result for step, (result, _, _) in zip(self.__steps, outputs, strict=True)}
+        error_count = sum(state_out.error_count - state_in.error_count for _, state_in, state_out in outputs)
+        return outputs[-1][0], ExecutionState(
+            self.__output_type.model_construct(**dict(context), **values), error_count
+        )
+
     def __call__(self, context: BaseModel) -> tuple[Any, ExecutionState]:
         assert isinstance(context, self.__input_type)
-        state = ExecutionState(context, 0)
-        for fn in self.__functions:
-            result, state = fn(state)
-        return result, state
+        futures: dict[int, Future[_StepOutput]] = {}
+
+        def run(step: TacticStep) -> _StepOutput:
+            state_in = self._step_state(step, context, {i: futures[i].result() for i in step.depends_on})
+            result, state_out = step.function(state_in)
+            return result, state_in, state_out
+
+        # 依存先の終了を待つ段がワーカーを占有しても詰まらないよう、段の数だけスレッドを用意する
+        with ThreadPoolExecutor(max_workers=len(self.__steps), thread_name_prefix="tactic") as executor:
+            for i, step in enumerate(self.__steps):
+                futures[i] = executor.submit(run, step)
+            return self._merge(context, [futures[i].result() for i in range(len(self.__steps))])
+
+    async def run_async(self, context: BaseModel) -> tuple[Any, ExecutionState]:
+        """__call__のasyncio版。多数の入力を同時に処理するときに使う。"""
+        assert isinstance(context, self.__input_type)
+        tasks: dict[int, asyncio.Task[_StepOutput]] = {}
+
+        async def run(step: TacticStep) -> _StepOutput:
+            state_in = self._step_state(step, context, {i: await tasks[i] for i in step.depends_on})
+            result, state_out = await step.async_function(state_in)
+            return result, state_in, state_out
+
+        for i, step in enumerate(self.__steps):
+            tasks[i] = asyncio.create_task(run(step))
+        try:
+            return self._merge(context, list(await asyncio.gather(*tasks.values())))
+        finally:
+            for task in tasks.values():
+                task.cancel()
 
 
 def type_to_preview(type_: Type) -> str:
@@ -198,17 +635,38 @@ class TacticBuilder:
         self.__typed_prompts: dict[str, TypedPrompt] = {}
         self.__input_type = input_type
         self.__current_context_type = input_type
-        self.__functions: list[Callable[[ExecutionState], tuple[ExecutionState, Any]]] = []
+        self.__steps: list[TacticStep] = []
 
-    def add_typed_prompt(self, name: str, adapter: Adapter, typed_prompt: TypedPrompt, executor: Executor):
+    def add_typed_prompt(
+        self,
+        name: str,
+        adapter: Adapter,
+        typed_prompt: TypedPrompt,
+        executor: Executor,
+        depends_on: Optional[Collection[str]] = None,
+    ):
+        """depends_onを省略すると、adapterが読むフィールドのうち前の段の出力になっているものを依存先とする。"""
         assert name not in self.__typed_prompts
+        step_names = [step.name for step in self.__steps]
+        if depends_on is None:
+            depends_on = step_names if adapter.reads is None else [x for x in step_names if x in adapter.reads]
+        dependencies: set[int] = set()
+        for dependency in depends_on:
+            assert dependency in step_names, f"unknown step: {dependency}"
+            i = step_names.index(dependency)
+            dependencies |= {i} | self.__steps[i].depends_on
+
         self.__typed_prompts[name] = typed_prompt
-        next_context_type = create_model(
-            f"_ContextTypeAfter_{name}",
-            **{name: (typed_prompt.output_type, None)},
-            __base__=self.__current_context_type,
-        )  # type: ignore
-        self.__functions.append(executor.build_function(name, adapter, typed_prompt, next_context_type))
+        next_context_type = context_type_after(self.__current_context_type, name, typed_prompt.output_type)
+        self.__steps.append(
+            TacticStep(
+                name=name,
+                context_type=self.__current_context_type,
+                function=executor.build_function(name, adapter, typed_prompt, next_context_type),
+                async_function=executor.build_async_function(name, adapter, typed_prompt, next_context_type),
+                depends_on=frozenset(dependencies),
+            )
+        )
         self.__current_context_type = next_context_type
 
     def show_typed_prompts(self, file=sys.stdout):
@@ -226,9 +684,12 @@ class TacticBuilder:
             file=file,
         )
 
-        for name, typed_prompt in self.__typed_prompts.items():
+        for step, (name, typed_prompt) in zip(self.__steps, self.__typed_prompts.items(), strict=True):
             print(
-                f"""[{name}.input_type]
+                f"""[{name}.depends_on]
+{", ".join(self.__steps[i].name for i in sorted(step.depends_on))}
+
+[{name}.input_type]
 {type_to_preview(typed_prompt.input_type)}
 
 [{name}.output_type]
@@ -244,18 +705,55 @@ class TacticBuilder:
         return Tactic(
             input_type=self.__input_type,
             output_type=self.__current_context_type,
-            functions=self.__functions.copy(),
+            steps=self.__steps.copy(),
         )
 
 
-_last_call = time.perf_counter()
-INTERVAL = 0.5
+CALL_GPT_MODEL = "gpt-4o-mini"
+
+_client: Optional[openai.OpenAI] = None
+_async_client: Optional[openai.AsyncOpenAI] = None
+
+
+def _openai_client() -> openai.OpenAI:
+    global _client
+    if _client is None:
+        _client = openai_client(api_key=openai.api_key)
+    return _client
+
+
+def _content(completion) -> str:
+    message = completion.choices[0].message
+    if message.content is None:
+        # structured outputsでは、出力を拒否するとcontentの代わりにrefusalが返る
+        raise RuntimeError(f"No content: {getattr(message, 'refusal', None)}")
+    return message.content
+
+
+def call_gpt(text, model=CALL_GPT_MODEL, rate_limiter: Optional[RateLimiter] = None, **kwargs):
+    """rate_limiterを省略するとプロセス全体で共有するopenai_rate_limiter()を使う。
+
+    kwargs(response_formatなど)はchat.completions.createにそのまま渡す。
+    """
+    completion = (rate_limiter or openai_rate_limiter()).call(
+        estimate_tokens(text),
+        _openai_client().chat.completions.create,
+        model=model,
+        messages=[{"role": "user", "content": text}],
+        **kwargs,
+    )
+    return _content(completion)
 
 
-def call_gpt(text, model="gpt-4o-mini"):
-    global _last_call
-    now = time.perf_counter()
-    if now - _last_call < INTERVAL:
-        time.sleep(INTERVAL - (now - _last_call))
-    completion = openai.chat.completions.create(model=model, messages=[{"role": "user", "content": text}])
-    return completion.choices[0].message.content
+async def call_gpt_async(text, model=CALL_GPT_MODEL, rate_limiter: Optional[RateLimiter] = None, **kwargs):
+    global _async_client
+    if _async_client is None:
+        _async_client = async_openai_client(api_key=openai.api_key)
+    completion = await (rate_limiter or openai_rate_limiter()).call_async(
+        estimate_tokens(text),
+        _async_client.chat.completions.create,
+        model=model,
+        messages=[{"role": "user", "content": text}],
+        **kwargs,
+    )
+    return _content(completion)
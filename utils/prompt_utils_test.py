@@ -0,0 +1,177 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest import TestCase, main
+
+from jinja2 import Template
+from pydantic import BaseModel
+
+from utils.llm_cache import LLMCache
+from utils.prompt_utils import Adapter, Executor, OutputParseError, TacticBuilder, TemplateRegistry, TypedPrompt
+
+
+class Paper(BaseModel):
+    title: str
+
+
+class Title(BaseModel):
+    title: str
+
+
+def _build(call, async_call=None):
+    builder = TacticBuilder("test", input_type=Paper)
+    for name in ["first", "second"]:
+        builder.add_typed_prompt(
+            name,
+            adapter=Adapter.project(Title),
+            typed_prompt=TypedPrompt(Template(name + ":{{ title }}"), input_type=Title, output_type=str),
+            executor=Executor(call, 1, async_call),
+        )
+
+    class Both(BaseModel):
+        first: str
+        second: str
+
+    builder.add_typed_prompt(
+        "both",
+        adapter=Adapter(lambda x: Both(first=x.first, second=x.second), reads=["first", "second"]),
+        typed_prompt=TypedPrompt(Template("{{ first }}+{{ second }}"), input_type=Both, output_type=str),
+        executor=Executor(call, 1, async_call),
+    )
+    return builder.build()
+
+
+class TacticTest(TestCase):
+    def test_independent_steps_run_concurrently(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def call(text: str) -> str:
+            with lock:
+                running.append(text)
+                peak.append(len(running))
+            time.sleep(0.1)
+            with lock:
+                running.remove(text)
+            return text.upper()
+
+        result, state = _build(call)(Paper(title="a"))
+        self.assertEqual(result, "FIRST:A+SECOND:A")
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(state.context.first, "FIRST:A")
+        self.assertEqual(state.context.second, "SECOND:A")
+        self.assertEqual(state.context.title, "a")
+
+    def test_context_types_are_reused(self):
+        tactic = _build(str.upper)
+        self.assertIs(_build(str.upper).output_type, tactic.output_type)
+        _, state = tactic(Paper(title="a"))
+        self.assertIsInstance(state.context, tactic.output_type)
+
+    def test_run_async_matches_sync(self):
+        async def async_call(text: str) -> str:
+            await asyncio.sleep(0.01)
+            return text.upper()
+
+        tactic = _build(str.upper, async_call)
+        self.assertEqual(asyncio.run(tactic.run_async(Paper(title="a"))), tactic(Paper(title="a")))
+
+
+class ExecutorCacheTest(TestCase):
+    def test_replays_parsed_outputs_only(self):
+        calls = []
+        outputs = iter(["not json", '{"title": "b"}'])
+
+        def call(text: str) -> str:
+            calls.append(text)
+            return next(outputs)
+
+        def build(cache: LLMCache):
+            builder = TacticBuilder("test", input_type=Paper)
+            builder.add_typed_prompt(
+                "parsed",
+                adapter=Adapter.identity(Paper),
+                typed_prompt=TypedPrompt(Template("{{ title }}"), input_type=Paper, output_type=Title),
+                executor=Executor(call, 2, cache=cache, model="m"),
+            )
+            return builder.build()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = LLMCache(Path(tmp) / "llm.db")
+            result, _ = build(cache)(Paper(title="a"))
+            self.assertEqual(result, Title(title="b"))
+            self.assertEqual(len(calls), 2)
+
+            result, _ = build(cache)(Paper(title="a"))
+            self.assertEqual(result, Title(title="b"))
+            self.assertEqual(asyncio.run(build(cache).run_async(Paper(title="a")))[0], Title(title="b"))
+            self.assertEqual(len(calls), 2)
+
+
+class Summary(BaseModel):
+    title: str
+    keywords: list[str]
+
+
+class StructuredOutputTest(TestCase):
+    def test_parse(self):
+        typed_prompt = TypedPrompt(Template(""), input_type=Paper, output_type=Summary)
+        self.assertEqual(typed_prompt.parse('```json\n{"title": "a", "keywords": []}\n```').title, "a")
+        with self.assertRaises(OutputParseError) as e:
+            typed_prompt.parse('{"title": "a", "keywords": "b"}')
+        self.assertEqual(e.exception.fields, ["keywords"])
+        self.assertEqual(e.exception.data, {"title": "a", "keywords": "b"})
+        with self.assertRaises(OutputParseError) as e:
+            typed_prompt.parse("not json")
+        self.assertIsNone(e.exception.data)
+
+    def test_re_asks_only_for_broken_fields(self):
+        calls = []
+
+        def call(text: str, response_format: dict) -> str:
+            calls.append(response_format["json_schema"])
+            if len(calls) == 1:
+                return '{"title": "a"}'
+            return '{"keywords": ["b"]}'
+
+        builder = TacticBuilder("test", input_type=Paper)
+        builder.add_typed_prompt(
+            "summary",
+            adapter=Adapter.identity(Paper),
+            typed_prompt=TypedPrompt(Template("{{ title }}"), input_type=Paper, output_type=Summary),
+            executor=Executor(call, 1, structured_output=True),
+        )
+        result, state = builder.build()(Paper(title="a"))
+        self.assertEqual(result, Summary(title="a", keywords=["b"]))
+        self.assertEqual(state.error_count, 0)
+        self.assertEqual([schema["name"] for schema in calls], ["Summary", "Summary_repair"])
+        self.assertTrue(calls[0]["strict"])
+        self.assertEqual(calls[0]["schema"]["required"], ["title", "keywords"])
+        self.assertEqual(list(calls[1]["schema"]["properties"]), ["keywords"])
+
+
+class TemplateRegistryTest(TestCase):
+    def test_reuses_and_reloads_templates(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "a.j2"
+            path.write_text("a:{{ title }}")
+            registry = TemplateRegistry(Path(tmp) / "bytecode")
+            template = registry.get(path)
+            source_hash = registry.source_hash(template.filename)
+            self.assertIs(registry.get(path), template)
+            self.assertEqual(registry.source_hash(template.filename), source_hash)
+
+            path.write_text("b:{{ title }}")
+            os.utime(path, ns=(path.stat().st_mtime_ns + 10**9,) * 2)
+            template = registry.get(path)
+            self.assertEqual(template.render(title="x"), "b:x")
+            self.assertNotEqual(registry.source_hash(template.filename), source_hash)
+            self.assertEqual(TemplateRegistry(Path(tmp) / "bytecode").get(path).render(title="x"), "b:x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import openai
+
+T = TypeVar("T")
+
+# OpenAI APIで共有する上限の既定値(gpt-4o-miniのTier 1相当)。環境変数で変えられる
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 200_000
+MAX_BACKOFF_SECONDS = 60.0
+# 429以外に、時間を置けば成功しうるステータス(OpenAI SDKが再試行するものと同じ)
+TRANSIENT_STATUS_CODES = {408, 409}
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の大まかな見積もり。日本語はほぼ1文字1トークン(UTF-8で3バイト)、英語は4文字程度で1トークンなので多めに出る。"""
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+class _Bucket:
+    """毎秒rateずつ、capacityまで溜まるトークンバケツ。残量は負になってよく、その分だけ後の呼び出しが待つ。"""
+
+    def __init__(self, per_minute: float, burst_seconds: float):
+        self.rate = per_minute / 60.0
+        self.capacity = max(self.rate * burst_seconds, 1.0)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= amount
+        return max(-self.level / self.rate, 0.0)
+
+
+def _status_code(error: BaseException) -> Optional[int]:
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """接続エラー・タイムアウト・408/409/5xxなど、呼び直せば成功しうるエラーか"""
+    if isinstance(error, openai.APIConnectionError):  # APITimeoutErrorを含む
+        return True
+    status_code = _status_code(error)
+    return status_code is not None and (status_code in TRANSIENT_STATUS_CODES or status_code >= 500)
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """エラーのレスポンスのRetry-After(-ms)ヘッダーの秒数。ヘッダーがなければNone"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000.0
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class RateLimiter:
+    """リクエスト数とトークン数のトークンバケツで、requests_per_minute回/分・tokens_per_minuteトークン/分を超えないようにする。
+
+    burst_seconds秒分までは間隔を空けずに呼び出せる。
+    429が返ったらRetry-After(なければ指数的に伸ばした時間)だけ、このRateLimiterを使う全ての呼び出しを止める。
+    接続エラーや5xxなどの一時的なエラーでは、その呼び出しだけが待って呼び直す。
+    スレッドセーフ。asyncioからは*_asyncを使う。
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float],
+        tokens_per_minute: Optional[float] = None,
+        burst_seconds: float = 1.0,
+    ):
+        self.__requests = _Bucket(requests_per_minute, burst_seconds) if requests_per_minute else None
+        self.__tokens = _Bucket(tokens_per_minute, burst_seconds) if tokens_per_minute else None
+        self.__lock = threading.Lock()
+        self.__blocked_until = 0.0
+        self.__consecutive_limited = 0
+
+    def _reserve(self, tokens: int) -> float:
+        # バケツから差し引き、この呼び出しが待つべき秒数を返す
+        with self.__lock:
+            now = time.monotonic()
+            wait = self.__blocked_until - now
+            if self.__requests is not None:
+                wait = max(wait, self.__requests.reserve(1, now))
+            if self.__tokens is not None and tokens > 0:
+                wait = max(wait, self.__tokens.reserve(tokens, now))
+        return wait
+
+    def acquire(self, tokens: int = 0):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: int = 0):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def backoff(self, retry_after: Optional[float]) -> float:
+        """429を受けたときに呼ぶ。全ての呼び出しを止める秒数を返す"""
+        with self.__lock:
+            self.__consecutive_limited += 1
+            if retry_after is None:
+                retry_after = min(2.0 ** (self.__consecutive_limited - 1), MAX_BACKOFF_SECONDS)
+            self.__blocked_until = max(self.__blocked_until, time.monotonic() + retry_after)
+        return retry_after
+
+    def _succeeded(self):
+        with self.__lock:
+            self.__consecutive_limited = 0
+
+    def _retry_delay(self, error: Exception, attempt: int, max_retries: int) -> Optional[float]:
+        """呼び直すまでにこの呼び出しが待つ秒数。呼び直さないならNone
+
+        429なら全ての呼び出しを止める(acquireで待つ)。一時的なエラーならこの呼び出しだけが指数的に待つ。
+        """
+        if attempt == max_retries:
+            return None
+        if _status_code(error) == 429:
+            delay = self.backoff(retry_after_seconds(error))
+            print(f"[WARN] Rate limited, retry in {delay:.1f}s ({attempt + 1}/{max_retries})", file=sys.stderr)
+            return 0.0
+        if is_transient_error(error):
+            delay = retry_after_seconds(error)
+            if delay is None:
+                delay = min(0.5 * 2.0**attempt, MAX_BACKOFF_SECONDS)
+            print(f"[WARN] {error!r}, retry in {delay:.1f}s ({attempt + 1}/{max_retries})", file=sys.stderr)
+            return delay
+        return None
+
+    def call(self, tokens: int, fn: Callable[..., T], *args, max_retries: int = 5, **kwargs) -> T:
+        """順番を待ってfnを呼ぶ。429や一時的なエラーならバックオフしてmax_retries回まで呼び直す"""
+        attempt = 0
+        while True:
+            self.acquire(tokens)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, max_retries)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._succeeded()
+            return result
+
+    async def call_async(
+        self, tokens: int, fn: Callable[..., Awaitable[T]], *args, max_retries: int = 5, **kwargs
+    ) -> T:
+        """callのasyncio版"""
+        attempt = 0
+        while True:
+            await self.acquire_async(tokens)
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, max_retries)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._succeeded()
+            return result
+
+
+_openai_rate_limiter: Optional[RateLimiter] = None
+_openai_rate_limiter_lock = threading.Lock()
+
+
+def openai_rate_limiter() -> RateLimiter:
+    """OpenAI APIの呼び出しでプロセス全体で共有するRateLimiter。
+
+    上限は環境変数OPENAI_REQUESTS_PER_MINUTE・OPENAI_TOKENS_PER_MINUTEで変えられる(初回の呼び出し時に読む)。
+    """
+    global _openai_rate_limiter
+    with _openai_rate_limiter_lock:
+        if _openai_rate_limiter is None:
+            _openai_rate_limiter = RateLimiter(
+                float(os.environ.get("OPENAI_REQUESTS_PER_MINUTE", DEFAULT_REQUESTS_PER_MINUTE)),
+                float(os.environ.get("OPENAI_TOKENS_PER_MINUTE", DEFAULT_TOKENS_PER_MINUTE)),
+            )
+        return _openai_rate_limiter
+
+
+def openai_client(**kwargs) -> openai.OpenAI:
+    """RateLimiter.callで呼ぶためのOpenAIクライアント。
+
+    再試行(429・一時的なエラー)はRateLimiterがまとめて行うので、SDK側では再試行しない。
+    SDKも再試行すると、待ち時間が二重になり、429が共有のRateLimiterに伝わらない。
+    """
+    return openai.OpenAI(max_retries=0, **kwargs)
+
+
+def async_openai_client(**kwargs) -> openai.AsyncOpenAI:
+    """openai_clientのasyncio版"""
+    return openai.AsyncOpenAI(max_retries=0, **kwargs)
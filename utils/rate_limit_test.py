@@ -0,0 +1,94 @@
+import asyncio
+import time
+from types import SimpleNamespace
+from unittest import TestCase, main
+
+import httpx
+import openai
+
+from utils.rate_limit import RateLimiter, is_transient_error, retry_after_seconds
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+    def __init__(self, headers: dict):
+        super().__init__("rate limited")
+        self.response = SimpleNamespace(status_code=429, headers=headers)
+
+
+class ServerError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__("server error")
+        self.status_code = status_code
+
+
+class RateLimiterTest(TestCase):
+    def test_requests_are_spaced(self):
+        # 600回/分、バースト0.1秒分(1回)なので、2回目以降は0.1秒ずつ空く
+        limiter = RateLimiter(600, burst_seconds=0.1)
+        start = time.monotonic()
+        for _ in range(4):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.29)
+
+    def test_tokens_are_limited_async(self):
+        limiter = RateLimiter(None, tokens_per_minute=60_000)
+        start = time.monotonic()
+
+        async def run():
+            await asyncio.gather(*[limiter.acquire_async(500) for _ in range(4)])
+
+        asyncio.run(run())
+        self.assertGreaterEqual(time.monotonic() - start, 0.99)
+
+    def test_retry_after_429(self):
+        calls = []
+
+        def fn():
+            calls.append(time.monotonic())
+            if len(calls) < 3:
+                raise RateLimited({"retry-after-ms": "100"})
+            return "ok"
+
+        self.assertEqual(RateLimiter(6000).call(1, fn), "ok")
+        self.assertGreaterEqual(calls[2] - calls[0], 0.19)
+
+    def test_retry_transient_errors(self):
+        request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+        errors = [ServerError(503), openai.APITimeoutError(request), openai.APIConnectionError(request=request)]
+        calls = []
+
+        async def fn():
+            calls.append(None)
+            if errors:
+                raise errors.pop(0)
+            return "ok"
+
+        self.assertEqual(asyncio.run(RateLimiter(6000).call_async(1, fn)), "ok")
+        self.assertEqual(len(calls), 4)
+
+    def test_is_transient_error(self):
+        self.assertTrue(is_transient_error(ServerError(500)))
+        self.assertTrue(is_transient_error(ServerError(408)))
+        self.assertFalse(is_transient_error(ServerError(400)))
+        self.assertFalse(is_transient_error(ValueError()))
+
+    def test_other_errors_are_not_retried(self):
+        calls = []
+
+        def fn():
+            calls.append(None)
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            RateLimiter(6000).call(1, fn)
+        self.assertEqual(len(calls), 1)
+
+    def test_retry_after_seconds(self):
+        self.assertEqual(retry_after_seconds(RateLimited({"retry-after": "2"})), 2.0)
+        self.assertIsNone(retry_after_seconds(RateLimited({})))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+import asyncio
+import time
+import traceback
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Collection,
+    Generic,
+    Hashable,
+    Iterable,
+    Optional,
+    TypeVar,
+)
+
+T = TypeVar("T")
+K = TypeVar("K")
+
+
+class KeyedTaskPool:
+    """キー付きのコルーチンをasyncioのタスクとして、同時実行数を制限して実行する。
+
+    実行待ち・実行中のタスクと同じキーで投入した場合は、新しく実行せずに既存のタスクを返す。
+    実行待ちのタスクはキーごと、またはグループ(例えばrequest_id)ごとに取り消せる。
+    イベントループのスレッドからのみ使うこと。
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.__semaphore = asyncio.Semaphore(max_concurrency)
+        self.__tasks: dict[Hashable, tuple[Hashable, asyncio.Task]] = {}
+        self.__started: set[Hashable] = set()
+
+    def submit(self, group: Hashable, key: Hashable, fn: Callable[..., Awaitable[Any]], *args) -> asyncio.Task:
+        if key in self.__tasks:
+            return self.__tasks[key][1]
+        task = asyncio.create_task(self._run(key, fn, *args))
+        self.__tasks[key] = (group, task)
+        task.add_done_callback(lambda _: self._remove(key, task))
+        return task
+
+    async def _run(self, key: Hashable, fn: Callable[..., Awaitable[Any]], *args):
+        async with self.__semaphore:
+            self.__started.add(key)
+            try:
+                return await fn(*args)
+            except Exception:
+                traceback.print_exc()
+                raise
+
+    def _remove(self, key: Hashable, task: asyncio.Task):
+        if key in self.__tasks and self.__tasks[key][1] is task:
+            del self.__tasks[key]
+            self.__started.discard(key)
+
+    def get(self, key: Hashable) -> Optional[asyncio.Task]:
+        task = self.__tasks.get(key)
+        return None if task is None else task[1]
+
+    def cancel_pending(self, key: Hashable) -> bool:
+        """keyのタスクがまだ実行待ちなら取り消してTrueを返す。"""
+        task = self.get(key)
+        if task is None or key in self.__started:
+            return False
+        return task.cancel()
+
+    def cancel_group(self, group: Hashable, keep: Collection[Hashable] = ()) -> int:
+        """groupの実行待ちタスクのうち、keepに含まれないものを取り消す。実行中のタスクはそのまま。"""
+        targets = [key for key, (task_group, _) in self.__tasks.items() if task_group == group and key not in keep]
+        return sum(self.cancel_pending(key) for key in targets)
+
+
+class SingleFlight:
+    """同じキーの処理が実行中なら新たに実行せず、その結果を一緒に待つ。イベントループのスレッドからのみ使うこと。
+
+    処理は呼び出し元とは別のタスクで動くので、待っている呼び出し元の一つが取り消されても処理は続く。
+    """
+
+    def __init__(self):
+        self.__tasks: dict[Hashable, asyncio.Task] = {}
+
+    def start(self, key: Hashable, fn: Callable[..., Awaitable[T]], *args) -> asyncio.Task:
+        """keyの処理が実行中ならそのタスクを、なければ新しく始めたタスクを返す。"""
+        task = self.__tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args))
+            self.__tasks[key] = task
+            task.add_done_callback(lambda _: self._remove(key, task))
+        return task
+
+    async def do(self, key: Hashable, fn: Callable[..., Awaitable[T]], *args) -> T:
+        return await asyncio.shield(self.start(key, fn, *args))
+
+    def _remove(self, key: Hashable, task: asyncio.Task):
+        if self.__tasks.get(key) is task:
+            del self.__tasks[key]
+
+    def get(self, key: Hashable) -> Optional[asyncio.Task]:
+        return self.__tasks.get(key)
+
+
+class TextBroadcast:
+    """生成途中の文字列を複数の読み手に配る。途中から読み始めても、最初の断片から受け取れる。
+
+    イベントループのスレッドからのみ使うこと。
+    """
+
+    def __init__(self):
+        self.__chunks: list[str] = []
+        self.__closed = False
+        self.__changed = asyncio.Event()
+
+    @property
+    def text(self) -> str:
+        return "".join(self.__chunks)
+
+    def append(self, chunk: str):
+        assert not self.__closed
+        self.__chunks.append(chunk)
+        self._notify()
+
+    def close(self):
+        self.__closed = True
+        self._notify()
+
+    def _notify(self):
+        # 待っている読み手を起こし、次の変更用に新しいEventにする
+        self.__changed.set()
+        self.__changed = asyncio.Event()
+
+    async def iter_chunks(self) -> AsyncIterator[str]:
+        i = 0
+        while True:
+            while i < len(self.__chunks):
+                yield self.__chunks[i]
+                i += 1
+            if self.__closed:
+                return
+            await self.__changed.wait()
+
+
+@dataclass
+class BatchResult(Generic[K, T]):
+    key: K
+    value: Optional[T] = None
+    error: Optional[BaseException] = None
+
+
+async def run_batch(
+    fn: Callable[[K], Awaitable[T]], keys: Iterable[K], max_concurrency: int
+) -> AsyncIterator[BatchResult[K, T]]:
+    """keysそれぞれについてfnを最大max_concurrency個ずつ同時に実行し、終わった順に結果を返す。
+
+    失敗した項目は例外をerrorに入れて返し、残りの項目は続ける。
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(key: K) -> BatchResult[K, T]:
+        async with semaphore:
+            try:
+                return BatchResult(key, value=await fn(key))
+            except Exception as e:
+                traceback.print_exc()
+                return BatchResult(key, error=e)
+
+    tasks = [asyncio.create_task(run(key)) for key in keys]
+    try:
+        for future in asyncio.as_completed(tasks):
+            yield await future
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+@dataclass
+class Stage(Generic[K]):
+    """Pipelineの1段。fn(key, 前の段の出力)を最大workers個同時に実行する。最初の段には前の段の出力の代わりにkeyを渡す。
+
+    queue_sizeはこの段の入力の待ち行列の長さの上限(0なら無制限)。満杯なら前の段は空くまで待つ。
+    """
+
+    name: str
+    fn: Callable[[K, Any], Awaitable[Any]]
+    workers: int
+    queue_size: int = 0
+
+
+@dataclass
+class StageMetrics:
+    name: str
+    workers: int
+    processed: int = 0
+    failed: int = 0
+    busy_seconds: float = 0.0  # 全てのワーカーがfnを実行していた時間の合計
+    utilization: float = 0.0  # busy_seconds / (経過時間 * workers)
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    mean_queue_depth: float = 0.0  # 経過時間で平均した待ち行列の長さ
+
+
+@dataclass
+class PipelineResult(Generic[K]):
+    key: K
+    value: Any = None
+    error: Optional[BaseException] = None
+    failed_stage: Optional[str] = None
+
+
+_STOP: Any = object()
+
+
+class Pipeline(Generic[K]):
+    """keyごとに段を順に実行する。段ごとにワーカーと待ち行列を持ち、あるkeyが後の段にある間に次のkeyを前の段で処理する。
+
+    待ち行列に上限があれば、後の段が詰まったときに前の段は先に進みすぎずに待つ(背圧)。
+    段ごとの処理数・稼働率・待ち行列の長さはmetricsで読める。一度だけ実行できる。
+    """
+
+    def __init__(self, stages: list[Stage[K]]):
+        assert stages
+        self.__stages = stages
+        self.__metrics = [StageMetrics(stage.name, stage.workers) for stage in stages]
+        # 待ち行列の長さの時間積分と、最後に長さが変わった時刻
+        self.__queue_depth_seconds = [0.0] * len(stages)
+        self.__queue_depth_updated = [time.monotonic()] * len(stages)
+
+    @property
+    def metrics(self) -> list[StageMetrics]:
+        return self.__metrics
+
+    def queue_depths(self) -> dict[str, int]:
+        return {metrics.name: metrics.queue_depth for metrics in self.__metrics}
+
+    def _add_queue_depth(self, i: int, delta: int):
+        metrics, now = self.__metrics[i], time.monotonic()
+        self.__queue_depth_seconds[i] += metrics.queue_depth * (now - self.__queue_depth_updated[i])
+        self.__queue_depth_updated[i] = now
+        metrics.queue_depth += delta
+        metrics.max_queue_depth = max(metrics.max_queue_depth, metrics.queue_depth)
+
+    def _finish(self, elapsed_seconds: float):
+        for i, metrics in enumerate(self.__metrics):
+            self._add_queue_depth(i, 0)
+            if elapsed_seconds > 0:
+                metrics.utilization = metrics.busy_seconds / (elapsed_seconds * metrics.workers)
+                metrics.mean_queue_depth = self.__queue_depth_seconds[i] / elapsed_seconds
+
+    async def run(self, keys: Iterable[K]) -> AsyncIterator[PipelineResult[K]]:
+        """全ての段を終えた、またはどこかの段で失敗したkeyを終わった順に返す。失敗したkeyは後の段に進めない。"""
+        queues: list[asyncio.Queue] = [asyncio.Queue(stage.queue_size) for stage in self.__stages]
+        results: asyncio.Queue = asyncio.Queue()
+        remaining = [stage.workers for stage in self.__stages]
+        start = time.monotonic()
+        self.__queue_depth_updated = [start] * len(self.__stages)
+
+        async def put(i: int, entry):
+            await queues[i].put(entry)
+            if entry is not _STOP:
+                self._add_queue_depth(i, 1)
+
+        async def feed():
+            for key in keys:
+                await put(0, (key, key))
+            for _ in range(self.__stages[0].workers):
+                await put(0, _STOP)
+
+        async def work(i: int):
+            stage, metrics = self.__stages[i], self.__metrics[i]
+            while True:
+                entry = await queues[i].get()
+                if entry is _STOP:
+                    break
+                self._add_queue_depth(i, -1)
+                key, value = entry
+                started = time.monotonic()
+                try:
+                    value = await stage.fn(key, value)
+                except Exception as e:
+                    traceback.print_exc()
+                    metrics.failed += 1
+                    metrics.busy_seconds += time.monotonic() - started
+                    await results.put(PipelineResult(key, error=e, failed_stage=stage.name))
+                    continue
+                metrics.processed += 1
+                metrics.busy_seconds += time.monotonic() - started
+                if i + 1 < len(self.__stages):
+                    await put(i + 1, (key, value))
+                else:
+                    await results.put(PipelineResult(key, value=value))
+            # 段の最後のワーカーが終わったら、次の段のワーカーを止める
+            remaining[i] -= 1
+            if remaining[i] > 0:
+                return
+            if i + 1 < len(self.__stages):
+                for _ in range(self.__stages[i + 1].workers):
+                    await put(i + 1, _STOP)
+            else:
+                await results.put(_STOP)
+
+        tasks = [asyncio.create_task(feed())]
+        for i, stage in enumerate(self.__stages):
+            tasks += [asyncio.create_task(work(i)) for _ in range(stage.workers)]
+        try:
+            while True:
+                result = await results.get()
+                if result is _STOP:
+                    break
+                yield result
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._finish(time.monotonic() - start)
+
+
+async def run_in_executor(executor: Optional[Executor], fn: Callable[..., T], *args, **kwargs) -> T:
+    return await asyncio.get_running_loop().run_in_executor(executor, lambda: fn(*args, **kwargs))
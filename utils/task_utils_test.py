@@ -0,0 +1,187 @@
+import asyncio
+from unittest import TestCase, main
+
+from utils.task_utils import KeyedTaskPool, Pipeline, SingleFlight, Stage, TextBroadcast
+
+
+class PipelineTest(TestCase):
+    def test_stages_overlap_and_failures_stop_early(self):
+        events = []
+
+        async def first(key: int, _) -> int:
+            events.append(("first", key))
+            await asyncio.sleep(0.01)
+            if key == 2:
+                raise RuntimeError()
+            return key * 10
+
+        async def second(key: int, value: int) -> int:
+            events.append(("second", key))
+            await asyncio.sleep(0.1)
+            return value + 1
+
+        pipeline = Pipeline([Stage("first", first, 1), Stage("second", second, 1)])
+
+        async def run():
+            return [result async for result in pipeline.run(range(4))]
+
+        results = {result.key: result for result in asyncio.run(run())}
+        self.assertEqual(
+            {key: result.value for key, result in results.items() if result.error is None}, {0: 1, 1: 11, 3: 31}
+        )
+        self.assertEqual(results[2].failed_stage, "first")
+        self.assertNotIn(("second", 2), events)
+        # 前のkeyがsecondにある間に、後のkeyのfirstが進む
+        self.assertLess(events.index(("first", 3)), events.index(("second", 1)))
+        first_metrics, second_metrics = pipeline.metrics
+        self.assertEqual((first_metrics.processed, first_metrics.failed), (3, 1))
+        self.assertEqual((second_metrics.processed, second_metrics.failed), (3, 0))
+        self.assertGreater(second_metrics.utilization, 0.5)
+
+    def test_bounded_queue_applies_backpressure(self):
+        async def first(key: int, _) -> int:
+            return key
+
+        async def second(key: int, value: int) -> int:
+            await asyncio.sleep(0.01)
+            return value
+
+        pipeline = Pipeline([Stage("first", first, 1), Stage("second", second, 1, queue_size=2)])
+
+        async def run():
+            return [result async for result in pipeline.run(range(10))]
+
+        self.assertEqual(len(asyncio.run(run())), 10)
+        self.assertEqual(pipeline.metrics[1].max_queue_depth, 2)
+
+
+class SingleFlightTest(TestCase):
+    def test_concurrent_callers_share_one_call(self):
+        calls = []
+
+        async def fetch(key: str) -> str:
+            calls.append(key)
+            await asyncio.sleep(0.01)
+            return key.upper()
+
+        async def run():
+            flights = SingleFlight()
+            results = await asyncio.gather(
+                *[flights.do("a", fetch, "a") for _ in range(3)], flights.do("b", fetch, "b")
+            )
+            self.assertIsNone(flights.get("a"))
+            # 終わった後は呼び直す
+            results.append(await flights.do("a", fetch, "a"))
+            return results
+
+        self.assertEqual(asyncio.run(run()), ["A", "A", "A", "B", "A"])
+        self.assertEqual(calls, ["a", "b", "a"])
+
+    def test_exception_is_shared(self):
+        calls = []
+
+        async def fail():
+            calls.append(None)
+            await asyncio.sleep(0.01)
+            raise ValueError("failed")
+
+        async def run():
+            flights = SingleFlight()
+            return await asyncio.gather(*[flights.do("a", fail) for _ in range(3)], return_exceptions=True)
+
+        results = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    def test_cancelled_caller_does_not_cancel_call(self):
+        async def fetch() -> str:
+            await asyncio.sleep(0.02)
+            return "done"
+
+        async def run():
+            flights = SingleFlight()
+            waiter = asyncio.create_task(flights.do("a", fetch))
+            await asyncio.sleep(0.005)
+            waiter.cancel()
+            return await flights.do("a", fetch)
+
+        self.assertEqual(asyncio.run(run()), "done")
+
+
+class TextBroadcastTest(TestCase):
+    def test_late_subscriber_gets_earlier_text(self):
+        async def run():
+            broadcast = TextBroadcast()
+
+            async def read() -> list[str]:
+                return [chunk async for chunk in broadcast.iter_chunks()]
+
+            broadcast.append("a")
+            early = asyncio.create_task(read())
+            await asyncio.sleep(0)
+            broadcast.append("b")
+            late = asyncio.create_task(read())
+            await asyncio.sleep(0)
+            broadcast.append("c")
+            broadcast.close()
+            after_close = await read()
+            return await early, await late, after_close, broadcast.text
+
+        early, late, after_close, text = asyncio.run(run())
+        self.assertEqual(early, ["a", "b", "c"])
+        self.assertEqual(late, ["a", "b", "c"])
+        self.assertEqual(after_close, ["a", "b", "c"])
+        self.assertEqual(text, "abc")
+
+
+class KeyedTaskPoolTest(TestCase):
+    def test_cancel_pending_only(self):
+        started = []
+
+        async def prefetch(key: int):
+            started.append(key)
+            await asyncio.sleep(0.02)
+            return key
+
+        async def run():
+            pool = KeyedTaskPool(max_concurrency=1)
+            finished = pool.submit("doc", 0, prefetch, 0)
+            await finished
+            running = pool.submit("doc", 1, prefetch, 1)
+            pending = pool.submit("doc", 2, prefetch, 2)
+            await asyncio.sleep(0)
+            self.assertIs(pool.submit("doc", 1, prefetch, 1), running)
+            self.assertFalse(pool.cancel_pending(0))
+            self.assertFalse(pool.cancel_pending(1))
+            self.assertTrue(pool.cancel_pending(2))
+            self.assertEqual(await running, 1)
+            self.assertTrue(pending.cancelled())
+            # 取り消したキーは投入し直せる
+            self.assertEqual(await pool.submit("doc", 2, prefetch, 2), 2)
+
+        asyncio.run(run())
+        self.assertEqual(started, [0, 1, 2])
+
+    def test_cancel_group(self):
+        started = []
+
+        async def prefetch(key: tuple[str, int]):
+            started.append(key)
+            await asyncio.sleep(0.01)
+
+        async def run():
+            pool = KeyedTaskPool(max_concurrency=1)
+            tasks = {key: pool.submit(key[0], key, prefetch, key) for key in [("a", 1), ("a", 2), ("a", 3), ("b", 1)]}
+            await asyncio.sleep(0)
+            # ("a", 1)は実行中なので残り、keepに含めた("a", 3)と別のグループの("b", 1)も残る
+            self.assertEqual(pool.cancel_group("a", keep={("a", 3)}), 1)
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            return {key: task.cancelled() for key, task in tasks.items()}
+
+        cancelled = asyncio.run(run())
+        self.assertEqual(cancelled, {("a", 1): False, ("a", 2): True, ("a", 3): False, ("b", 1): False})
+        self.assertEqual(started, [("a", 1), ("a", 3), ("b", 1)])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,459 @@
+import hashlib
 import io
+import itertools
+import json
 import os
+import re
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import wave
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional
 
 import requests
 from pydub import AudioSegment
+from pydub.utils import get_encoder_name
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from utils.cache_utils import DiskLRUCache, temp_path_for
 from utils.json_utils import Bson
 
+DEFAULT_VOICE_CACHE_DIR = Path("_cache/voicevox")
+DEFAULT_VOICE_CACHE_BYTES = 2 * 1024**3
+# エンジンのバージョン(音声キャッシュのキーの一部)を取り直す間隔。エンジンを更新したら、この時間のうちに新しいキーになる
+ENGINE_VERSION_TTL_SECONDS = 10 * 60
 
-def split_text(text: str, max_length: int, separetors: list[str]):
-    if len(text) < max_length:
-        return [text]
 
-    sub = text[:max_length]
-    candidates = [sub.rsplit(separetor, 1)[0] + separetor for separetor in separetors if separetor in sub]
-    if candidates:
-        pos = max([len(x) for x in candidates])
-    else:
-        pos = max_length
+def iter_split_text(text: str, max_length: int, separetors: list[str]) -> Iterator[str]:
+    """textをmax_length以下の長さ毎に、なるべく区切り文字の直後で分割して順に返す。
 
-    return [text[:pos]] + split_text(text[pos:], max_length, separetors)
+    区切り文字の出現位置を最初に一度だけ求めておき、各チャンクの切れ目は二分探索で決める。
+    """
+    separator_ends = [
+        (len(separetor), [m.start() + len(separetor) for m in re.finditer(f"(?={re.escape(separetor)})", text)])
+        for separetor in separetors
+    ]
 
+    start = 0
+    while len(text) - start >= max_length:
+        limit = start + max_length
+        best = None
+        for separetor_length, ends in separator_ends:
+            i = bisect_right(ends, limit) - 1
+            if i >= 0 and ends[i] - separetor_length >= start and (best is None or ends[i] > best):
+                best = ends[i]
+        pos = limit if best is None else best
+        yield text[start:pos]
+        start = pos
+    yield text[start:]
 
-def text_to_segment(text: str, speaker: "VoiceVoxSpeaker", max_length=300):
-    texts = split_text(text, max_length, separetors=["。", "、", ". "])
-    return sum([speaker.create_audio_segment(text) for text in texts], AudioSegment.empty())
 
+def split_text(text: str, max_length: int, separetors: list[str]) -> list[str]:
+    return list(iter_split_text(text, max_length, separetors))
 
-def text_to_wav(text: str, speaker: "VoiceVoxSpeaker", output: Path, max_length=300):
-    texts = split_text(text, max_length, separetors=["。", "、", ". "])
-    segments = [speaker.create_audio_segment(text) for text in texts]
-    sound = sum(segments, AudioSegment.empty())
-    sound.export(output, format=os.path.splitext(output.name)[-1][1:])
+
+def iter_audio_segments(
+    texts: Iterable[str], speaker: "VoiceVoxSpeaker", max_workers: int = 1
+) -> Iterator[AudioSegment]:
+    """textsを順に音声化する。max_workers>1のときは並列に合成し、入力順で返す。
+
+    先読みはmax_workers * 2件までに抑える。エンジン全体の同時リクエスト数はspeaker.pool_sizeで抑える。
+    """
+    if max_workers <= 1:
+        for text in texts:
+            yield speaker.create_audio_segment(text)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="voicevox") as executor:
+        pending: deque = deque()
+        try:
+            for text in texts:
+                pending.append(executor.submit(speaker.create_audio_segment, text))
+                if len(pending) >= max_workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _match_format(segment: AudioSegment, frame_rate: int, channels: int, sample_width: int) -> AudioSegment:
+    if segment.frame_rate != frame_rate:
+        segment = segment.set_frame_rate(frame_rate)
+    if segment.channels != channels:
+        segment = segment.set_channels(channels)
+    if segment.sample_width != sample_width:
+        segment = segment.set_sample_width(sample_width)
+    return segment
+
+
+def concat_segments(segments: Iterable[AudioSegment]) -> AudioSegment:
+    """AudioSegmentを連結する。sum()と違い、PCMを一度だけ結合するので線形時間で済む。"""
+    chunks: list[bytes] = []
+    first: Optional[AudioSegment] = None
+    for segment in segments:
+        if first is None:
+            first = segment
+        else:
+            segment = _match_format(segment, first.frame_rate, first.channels, first.sample_width)
+        chunks.append(segment.raw_data)
+    if first is None:
+        return AudioSegment.empty()
+    return first._spawn(b"".join(chunks))
+
+
+_FFMPEG_SAMPLE_FORMATS = {1: "u8", 2: "s16le", 4: "s32le"}
+
+
+def _ffmpeg_encode_command(frame_rate: int, channels: int, sample_width: int, format: str, output: str) -> list[str]:
+    return [
+        get_encoder_name(),
+        "-y",
+        "-loglevel",
+        "error",
+        "-probesize",
+        "32",
+        "-analyzeduration",
+        "0",
+        "-f",
+        _FFMPEG_SAMPLE_FORMATS[sample_width],
+        "-ar",
+        str(frame_rate),
+        "-ac",
+        str(channels),
+        "-i",
+        "pipe:0",
+        "-f",
+        format,
+        "-flush_packets",
+        "1",
+        output,
+    ]
+
+
+class StreamingAudioWriter:
+    """AudioSegmentを受け取った順に出力ファイルへ書き出す。
+
+    wavはwaveモジュールで直接、それ以外はffmpegの標準入力へPCMを流し込んでエンコードするため、
+    メモリに載るのは書き込み中のチャンクだけになる。フォーマットは最初のチャンクに合わせる。
+    書き込み中は一時ファイルに書き、closeで出力先に置き換えるので、書きかけのファイルは見えない。
+    """
+
+    def __init__(self, output: Path, format: Optional[str] = None):
+        self.__output = output
+        self.__tmp_output = temp_path_for(output)
+        self.__format = format or os.path.splitext(output.name)[-1][1:]
+        self.__params: Optional[tuple[int, int, int]] = None
+        self.__wave: Optional[wave.Wave_write] = None
+        self.__process: Optional[subprocess.Popen] = None
+        self.__stderr = None
+
+    def __enter__(self) -> "StreamingAudioWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _open(self, frame_rate: int, channels: int, sample_width: int):
+        self.__params = (frame_rate, channels, sample_width)
+        if self.__format == "wav":
+            self.__wave = wave.open(str(self.__tmp_output), "wb")
+            self.__wave.setframerate(frame_rate)
+            self.__wave.setnchannels(channels)
+            self.__wave.setsampwidth(sample_width)
+            return
+
+        self.__stderr = tempfile.TemporaryFile()
+        self.__process = subprocess.Popen(
+            _ffmpeg_encode_command(frame_rate, channels, sample_width, self.__format, str(self.__tmp_output)),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=self.__stderr,
+        )
+
+    def write(self, segment: AudioSegment):
+        if self.__params is None:
+            self._open(segment.frame_rate, segment.channels, segment.sample_width)
+        else:
+            segment = _match_format(segment, *self.__params)
+
+        if self.__wave is not None:
+            self.__wave.writeframes(segment.raw_data)
+        else:
+            assert self.__process is not None and self.__process.stdin is not None
+            self.__process.stdin.write(segment.raw_data)
+
+    def close(self):
+        if self.__params is None:
+            AudioSegment.empty().export(self.__tmp_output, format=self.__format)
+        elif self.__wave is not None:
+            self.__wave.close()
+        else:
+            assert self.__process is not None and self.__process.stdin is not None
+            self.__process.stdin.close()
+            returncode = self.__process.wait()
+            self.__stderr.seek(0)
+            message = self.__stderr.read().decode("utf-8", errors="replace")
+            self.__stderr.close()
+            if returncode != 0:
+                self.__tmp_output.unlink(missing_ok=True)
+                raise RuntimeError(f"ffmpeg returns {returncode}\n{message}")
+        os.replace(self.__tmp_output, self.__output)
+
+    def abort(self):
+        if self.__wave is not None:
+            self.__wave.close()
+        if self.__process is not None:
+            self.__process.kill()
+            self.__process.wait()
+            self.__stderr.close()
+        self.__tmp_output.unlink(missing_ok=True)
+
+
+def iter_encoded_audio(segments: Iterable[AudioSegment], format: str = "mp3", chunk_size: int = 16 * 1024):
+    """AudioSegmentをエンコードしながら、できたバイト列から順に返す。
+
+    最初のチャンクが届いた時点で出力が始まるので、全体の合成を待たずに配信・再生できる。
+    """
+    segments = iter(segments)
+    first = next(segments, None)
+    if first is None:
+        with io.BytesIO() as f_out:
+            AudioSegment.empty().export(f_out, format=format)
+            yield f_out.getvalue()
+        return
+
+    params = (first.frame_rate, first.channels, first.sample_width)
+    stderr = tempfile.TemporaryFile()
+    process = subprocess.Popen(
+        _ffmpeg_encode_command(*params, format, "pipe:1"),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=stderr,
+    )
+    assert process.stdin is not None and process.stdout is not None
+    stdin, stdout = process.stdin, process.stdout
+    errors: list[Exception] = []
+
+    def feed():
+        try:
+            for segment in itertools.chain([first], segments):
+                data = _match_format(segment, *params).raw_data
+                try:
+                    stdin.write(data)
+                    stdin.flush()
+                except (BrokenPipeError, ValueError):
+                    # 読み出し側が先に終了した
+                    return
+        except Exception as e:
+            errors.append(e)
+            process.kill()
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    completed = False
+    try:
+        while chunk := stdout.read1(chunk_size):
+            yield chunk
+        completed = True
+    finally:
+        if not completed:
+            process.kill()
+        returncode = process.wait()
+        stdout.close()
+
+    feeder.join()
+    stderr.seek(0)
+    message = stderr.read().decode("utf-8", errors="replace")
+    stderr.close()
+    if errors:
+        raise errors[0]
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg returns {returncode}\n{message}")
+
+
+def text_to_audio_stream(
+    text: str,
+    speaker: "VoiceVoxSpeaker",
+    format: str = "mp3",
+    output: Optional[Path] = None,
+    max_length=300,
+    max_workers: int = 1,
+    part_path: Optional[Path] = None,
+) -> Iterator[bytes]:
+    """textを音声化しながらエンコード済みのバイト列を返す。
+
+    outputを指定すると、最後まで読まれた場合に保存する。書き込み途中の内容はpart_pathに逐次書き出す。
+    """
+    texts = iter_split_text(text, max_length, separetors=["。", "、", ". "])
+    chunks = iter_encoded_audio(iter_audio_segments(texts, speaker, max_workers), format)
+    if output is None:
+        yield from chunks
+        return
+
+    if part_path is None:
+        part_path = temp_path_for(output)
+    try:
+        with part_path.open("wb") as f_out:
+            for chunk in chunks:
+                f_out.write(chunk)
+                f_out.flush()
+                yield chunk
+        os.replace(part_path, output)
+        print(f"done: {output}", file=sys.stderr)
+    finally:
+        part_path.unlink(missing_ok=True)
+
+
+def text_to_segment(text: str, speaker: "VoiceVoxSpeaker", max_length=300, max_workers: int = 1):
+    texts = iter_split_text(text, max_length, separetors=["。", "、", ". "])
+    return concat_segments(iter_audio_segments(texts, speaker, max_workers))
+
+
+def text_to_wav(text: str, speaker: "VoiceVoxSpeaker", output: Path, max_length=300, max_workers: int = 1):
+    texts = iter_split_text(text, max_length, separetors=["。", "、", ". "])
+    with StreamingAudioWriter(output) as writer:
+        for segment in iter_audio_segments(texts, speaker, max_workers):
+            writer.write(segment)
 
     print(f"done: {output}", file=sys.stderr)
 
 
+_sessions: dict[tuple[int, int, float], requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_voicevox_session(pool_size: int = 4, max_retries: int = 3, backoff_factor: float = 0.5) -> requests.Session:
+    """VoiceVox用のkeep-aliveセッションを返す。同じ設定ならプロセス内で共有する。
+
+    5xxと接続エラーはbackoff_factorに従って指数的に待ちながらmax_retries回まで再試行する。
+    """
+    key = (pool_size, max_retries, backoff_factor)
+    with _sessions_lock:
+        if key not in _sessions:
+            retry = Retry(
+                total=max_retries,
+                backoff_factor=backoff_factor,
+                status_forcelist=(500, 502, 503, 504),
+                allowed_methods=None,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[key] = session
+        return _sessions[key]
+
+
+# url -> (バージョン, 取得したtime.monotonic())
+_engine_versions: dict[str, tuple[str, float]] = {}
+_engine_versions_lock = threading.Lock()
+_engine_semaphores: dict[str, threading.BoundedSemaphore] = {}
+_engine_semaphores_lock = threading.Lock()
+
+
+def get_engine_semaphore(url: str, max_concurrency: int) -> threading.BoundedSemaphore:
+    """urlのエンジンへの同時リクエスト数を抑えるセマフォ。プロセス内で共有し、上限は最初に作ったときの値になる。"""
+    with _engine_semaphores_lock:
+        if url not in _engine_semaphores:
+            _engine_semaphores[url] = threading.BoundedSemaphore(max_concurrency)
+        return _engine_semaphores[url]
+
+
+def create_voice_cache(root: Path = DEFAULT_VOICE_CACHE_DIR, max_bytes: int = DEFAULT_VOICE_CACHE_BYTES):
+    return DiskLRUCache(root, max_bytes, suffix=".wav")
+
+
 @dataclass
 class VoiceVoxSpeaker:
+    """VoiceVoxエンジンで音声を合成する。
+
+    pool_sizeは同じエンジンへの同時合成数の上限で、接続プールの大きさも同じにする。
+    iter_audio_segmentsのmax_workersや同時に走らせるジョブの数によらず、エンジンへの同時リクエストはこれを超えない。
+    """
+
     speaker_id: str
     url: str
     speed: float = 1.0
     volume: float = 1.0
+    pool_size: int = 4
+    timeout: float = 60.0
+    max_retries: int = 3
+    backoff_factor: float = 0.5
+    cache: Optional[DiskLRUCache] = None
+
+    @property
+    def session(self) -> requests.Session:
+        return get_voicevox_session(self.pool_size, self.max_retries, self.backoff_factor)
+
+    @property
+    def engine_version(self) -> str:
+        """エンジンのバージョン。ENGINE_VERSION_TTL_SECONDSごとに取り直し、取れなければ前回取れた値を使う"""
+        with _engine_versions_lock:
+            cached = _engine_versions.get(self.url)
+            if cached is not None and time.monotonic() - cached[1] < ENGINE_VERSION_TTL_SECONDS:
+                return cached[0]
+            try:
+                response = self.session.get(f"{self.url}/version", timeout=self.timeout)
+                if not response.ok:
+                    raise RuntimeError(f"voicevox api returns {response.status_code}")
+                version = response.json()
+            except (requests.RequestException, RuntimeError, ValueError) as e:
+                if cached is None:
+                    raise
+                print(f"[WARN] Failed to get voicevox version, use {cached[0]}: {e!r}", file=sys.stderr)
+                version = cached[0]
+            _engine_versions[self.url] = (version, time.monotonic())
+            return version
+
+    def cache_key(self, text: str) -> str:
+        key = [text, self.speaker_id, self.speed, self.volume, self.engine_version]
+        return hashlib.sha256(json.dumps(key, ensure_ascii=False).encode("utf-8")).hexdigest()
 
     def create_audio_segment(self, text: str) -> AudioSegment:
-        response = requests.post(f"{self.url}/audio_query", params={"speaker": self.speaker_id, "text": text})
+        # VoiceVoxはwavを返すので、ffmpegを通さずに読む
+        return AudioSegment.from_file(io.BytesIO(self.synthesize(text)), format="wav")
+
+    def synthesize(self, text: str) -> bytes:
+        if self.cache is None:
+            return self._synthesize(text)
+
+        key = self.cache_key(text)
+        data = self.cache.get(key)
+        if data is None:
+            data = self._synthesize(text)
+            self.cache.put(key, data)
+        return data
+
+    def _synthesize(self, text: str) -> bytes:
+        with get_engine_semaphore(self.url, self.pool_size):
+            return self.__synthesize(text)
+
+    def __synthesize(self, text: str) -> bytes:
+        session = self.session
+        response = session.post(
+            f"{self.url}/audio_query",
+            params={"speaker": self.speaker_id, "text": text},
+            timeout=self.timeout,
+        )
 
         if not response.ok:
             raise RuntimeError(f"voicevox api returns {response.status_code}")
@@ -55,11 +462,13 @@ class VoiceVoxSpeaker:
         synthesis_config["speedScale"] = self.speed
         synthesis_config["volumeScale"] = self.volume
 
-        synthesis_response = requests.post(
-            f"{self.url}/synthesis?speaker={self.speaker_id}",
-            headers={"Context-Type": "application/json"},
+        synthesis_response = session.post(
+            f"{self.url}/synthesis",
+            params={"speaker": self.speaker_id},
+            headers={"Content-Type": "application/json"},
             data=synthesis_config.as_bytes(),
+            timeout=self.timeout,
         )
         if not synthesis_response.ok:
             raise RuntimeError(f"voicevox api returns {synthesis_response.status_code}")
-        return AudioSegment.from_file(io.BytesIO(synthesis_response.content))
+        return synthesis_response.content
@@ -0,0 +1,215 @@
+import io
+import json
+import random
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Optional
+from unittest import TestCase, main
+
+from pydub import AudioSegment
+
+from utils import voice_utils
+from utils.voice_utils import (
+    StreamingAudioWriter,
+    VoiceVoxSpeaker,
+    concat_segments,
+    iter_audio_segments,
+    iter_split_text,
+    split_text,
+    text_to_wav,
+)
+
+SEPARATORS = ["。", "、", ". "]
+
+
+def _split_text_recursive(text: str, max_length: int, separetors: list[str]):
+    if len(text) < max_length:
+        return [text]
+
+    sub = text[:max_length]
+    candidates = [sub.rsplit(separetor, 1)[0] + separetor for separetor in separetors if separetor in sub]
+    if candidates:
+        pos = max([len(x) for x in candidates])
+    else:
+        pos = max_length
+
+    return [text[:pos]] + _split_text_recursive(text[pos:], max_length, separetors)
+
+
+class SplitTextTest(TestCase):
+    def test_short_text(self):
+        self.assertEqual(split_text("こんにちは。", 300, SEPARATORS), ["こんにちは。"])
+
+    def test_split_at_last_separator(self):
+        self.assertEqual(
+            split_text("あいう。えお、かきくけこ", 8, SEPARATORS),
+            ["あいう。えお、", "かきくけこ"],
+        )
+
+    def test_split_without_separator(self):
+        self.assertEqual(split_text("abcdefg", 3, SEPARATORS), ["abc", "def", "g"])
+
+    def test_same_as_recursive_version(self):
+        rng = random.Random(0)
+        alphabet = ["あ", "い", "う", "。", "、", ".", " ", "a"]
+        for _ in range(200):
+            text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 200)))
+            max_length = rng.randint(1, 30)
+            self.assertEqual(
+                split_text(text, max_length, SEPARATORS), _split_text_recursive(text, max_length, SEPARATORS)
+            )
+
+    def test_long_text(self):
+        text = "これは長い文章です。" * 100_000
+        chunks = iter_split_text(text, 300, SEPARATORS)
+        self.assertEqual("".join(chunks), text)
+
+
+class FakeSession:
+    """VoiceVoxの /audio_query と /synthesis を真似る。同時に処理しているリクエスト数の最大を記録する"""
+
+    def __init__(self, synthesize=lambda text: text.encode("utf-8"), delay: float = 0.0):
+        self.__synthesize = synthesize
+        self.__delay = delay
+        self.__lock = threading.Lock()
+        self.__active = 0
+        self.max_active = 0
+
+    version: Optional[str] = "0.1.0"
+    version_requests = 0
+
+    def get(self, url: str, timeout: float):
+        assert url.endswith("/version")
+        self.version_requests += 1
+        version = self.version
+        return SimpleNamespace(ok=version is not None, status_code=503, json=lambda: version)
+
+    def post(self, url: str, params: dict, timeout: float, **kwargs):
+        with self.__lock:
+            self.__active += 1
+            self.max_active = max(self.max_active, self.__active)
+        try:
+            time.sleep(self.__delay)
+            if url.endswith("/audio_query"):
+                return SimpleNamespace(ok=True, content=json.dumps({"text": params["text"]}).encode("utf-8"))
+            return SimpleNamespace(ok=True, content=self.__synthesize(json.loads(kwargs["data"])["text"]))
+        finally:
+            with self.__lock:
+                self.__active -= 1
+
+
+class FakeSpeaker(VoiceVoxSpeaker):
+    fake_session: FakeSession
+
+    @property
+    def session(self):
+        return self.fake_session
+
+
+def fake_speaker(session: FakeSession, url: str, **kwargs) -> FakeSpeaker:
+    speaker = FakeSpeaker("1", url, **kwargs)
+    speaker.fake_session = session
+    return speaker
+
+
+class VoiceVoxSpeakerTest(TestCase):
+    def test_concurrency_per_engine(self):
+        # 別々のインスタンス・別々の並列合成からでも、同じエンジンへの同時リクエストはpool_sizeまで
+        session = FakeSession(delay=0.02)
+        speakers = [fake_speaker(session, "http://engine-a", pool_size=2) for _ in range(4)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda i: speakers[i % 4].synthesize(f"t{i}"), range(16)))
+        self.assertEqual(results, [f"t{i}".encode("utf-8") for i in range(16)])
+        self.assertEqual(session.max_active, 2)
+
+    def test_engine_version_is_refreshed_and_falls_back(self):
+        session = FakeSession()
+        speaker = fake_speaker(session, "http://engine-version")
+        key = speaker.cache_key("text")
+        self.assertEqual(speaker.cache_key("text"), key)
+        self.assertEqual(session.version_requests, 1)
+
+        ttl = voice_utils.ENGINE_VERSION_TTL_SECONDS
+        voice_utils.ENGINE_VERSION_TTL_SECONDS = 0
+        try:
+            # エンジンが落ちていたら前回のバージョンで引ける
+            session.version = None
+            self.assertEqual(speaker.cache_key("text"), key)
+            # 更新されたら新しいキーになる
+            session.version = "0.2.0"
+            self.assertNotEqual(speaker.cache_key("text"), key)
+        finally:
+            voice_utils.ENGINE_VERSION_TTL_SECONDS = ttl
+        self.assertEqual(session.version_requests, 3)
+
+
+def wav_bytes(value: int, frames: int = 100, frame_rate: int = 24000) -> bytes:
+    # どのテキストの音声か分かるよう、全サンプルをvalueにしたwav
+    with io.BytesIO() as f_out:
+        with wave.open(f_out, "wb") as w:
+            w.setframerate(frame_rate)
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.writeframes(value.to_bytes(2, "little", signed=True) * frames)
+        return f_out.getvalue()
+
+
+def slow_wav(text: str) -> bytes:
+    # 後のテキストほど先に終わるようにして、並列に合成したときに完了順が入れ替わるようにする
+    value = int(text.rstrip("。"))
+    time.sleep(0.002 * (20 - value % 20))
+    return wav_bytes(value)
+
+
+def sample_values(segment: AudioSegment, frames: int = 100) -> list[int]:
+    samples = segment.get_array_of_samples()
+    return [samples[i] for i in range(0, len(samples), frames)]
+
+
+class AudioSegmentsTest(TestCase):
+    def setUp(self):
+        self.__tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.__tmp.name)
+
+    def tearDown(self):
+        self.__tmp.cleanup()
+
+    def test_segments_keep_input_order(self):
+        speaker = fake_speaker(FakeSession(slow_wav), "http://engine-order", pool_size=4)
+        for max_workers in [1, 4]:
+            segments = list(iter_audio_segments([str(i) for i in range(20)], speaker, max_workers=max_workers))
+            self.assertEqual([sample_values(segment)[0] for segment in segments], list(range(20)))
+
+    def test_concat_segments(self):
+        segments = [AudioSegment.from_file(io.BytesIO(wav_bytes(i)), format="wav") for i in range(3)]
+        # フォーマットの違うものは最初のものに合わせる
+        segments.append(AudioSegment.from_file(io.BytesIO(wav_bytes(3, frames=50, frame_rate=12000)), format="wav"))
+        concatenated = concat_segments(segments)
+        self.assertEqual(concatenated.frame_rate, 24000)
+        self.assertEqual(sample_values(concatenated), [0, 1, 2, 3])
+        self.assertEqual(len(concat_segments([])), 0)
+
+    def test_text_to_wav(self):
+        speaker = fake_speaker(FakeSession(slow_wav), "http://engine-wav", pool_size=2)
+        output = self.root / "out.wav"
+        text_to_wav("".join(f"{i}。" for i in range(1, 10)), speaker, output, max_length=3, max_workers=2)
+        self.assertEqual(sample_values(AudioSegment.from_file(output, format="wav")), list(range(1, 10)))
+        self.assertEqual([path.name for path in self.root.iterdir()], ["out.wav"])
+
+    def test_writer_removes_temp_file_on_error(self):
+        output = self.root / "out.wav"
+        with self.assertRaises(RuntimeError):
+            with StreamingAudioWriter(output) as writer:
+                writer.write(AudioSegment.from_file(io.BytesIO(wav_bytes(1)), format="wav"))
+                self.assertEqual(len(list(self.root.iterdir())), 1)
+                raise RuntimeError()
+        self.assertEqual(list(self.root.iterdir()), [])
+
+
+if __name__ == "__main__":
+    main()
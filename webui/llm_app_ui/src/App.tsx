@@ -27,7 +27,7 @@ export default function DocumentViewer() {
   const generate = async (reqId: string, page: number, regenerate: boolean) => {
     var error: boolean = false
     setIsLoading(true)
-    const runExplain = (regenerate ? client.regenerate(reqId, page) : client.explain(reqId, page)).then((explanation: string | null) => {
+    const runExplain = (regenerate ? client.regenerate(reqId, page) : client.explainStream(reqId, page, setExplanation)).then((explanation: string | null) => {
       if (explanation !== null) {
         setExplanation(explanation)
       } else {
@@ -42,15 +42,11 @@ export default function DocumentViewer() {
       }
     })
     await Promise.all([runExplain, runImage])
-    await client.audio(reqId, page).then((audioUrl: string | null) => {
-      if (audioUrl !== null) {
-        setAudioUrl(audioUrl)
-        setVolumeToAudio(volume)
-        setSpeakingToAudio(speaking)
-      } else {
-        error = true
-      }
-    })
+    if (!error) {
+      setAudioUrl(client.audioStreamUrl(reqId, page))
+      setVolumeToAudio(volume)
+      setSpeakingToAudio(speaking)
+    }
 
     setIsLoading(false)
     if (error) {
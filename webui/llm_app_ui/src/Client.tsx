@@ -28,6 +28,28 @@ class Client {
     }
   }
 
+  explainStream(request_id: string, page: number, onText: (text: string) => void): Promise<string | null> {
+    // Server-Sent Eventsで生成途中の解説を受け取り、届くたびにそれまでの全文をonTextに渡す
+    const params = new URLSearchParams({ request_id, page: page.toString() })
+    return new Promise((resolve) => {
+      const source = new EventSource(`/explain_stream/?${params.toString()}`)
+      let text = ''
+      source.addEventListener('delta', (event) => {
+        text += JSON.parse((event as MessageEvent).data).text
+        onText(text)
+      })
+      source.addEventListener('done', (event) => {
+        source.close()
+        resolve(JSON.parse((event as MessageEvent).data).explanation)
+      })
+      source.addEventListener('error', (event) => {
+        source.close()
+        console.error('Error streaming explanation:', (event as MessageEvent).data ?? event)
+        resolve(null)
+      })
+    })
+  }
+
   async image(request_id: string, page: number): Promise<string | null> {
     if (this.cache[request_id] && this.cache[request_id][page]) {
       return this.cache[request_id][page]
@@ -56,6 +78,12 @@ class Client {
     }
   }
 
+  audioStreamUrl(request_id: string, page: number): string {
+    // 未合成でも最初のチャンクから再生が始まる。再生成後に読み直させるため時刻を付ける
+    const params = new URLSearchParams({ request_id, page: page.toString(), t: Date.now().toString() })
+    return `/audio_stream/?${params.toString()}`
+  }
+
   async regenerate(request_id: string, page: number): Promise<string|null> {
     try {
       const regenerateResponse = await axios.post(`/regenerate/`, { request_id, page })